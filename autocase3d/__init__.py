@@ -1,51 +1,29 @@
 import numpy as np
-import cortex
-import plyfile
 import os
-import sklearn.mixture
-import scipy.optimize
 from numpy import sin, cos
 
-from .util import get_ply_features
+# sklearn, scipy and the mesh readers of .util are slow to import, so they are
+# imported by the functions that use them.
 
 def fit_model(feature_dir="autocase/features", n_ppl=50, n_pts=1000, 
-              n_components=100):
-    """
-    """
-    # load all the feature files, one for each head
-    features = [np.load(os.path.join(feature_dir, f), encoding='bytes')["features"] 
-                for f in os.listdir(feature_dir)]
-
-    # compute means & stds for z-scoring
-    stds = np.vstack([f.std(0) for f in features])
-    means = np.vstack([f.mean(0) for f in features])
-
-    mean_stds = stds.mean(0)
-    print(mean_stds)
-
-    # but let's make sure we use the same scale for each spatial dim
-    use_stds = np.hstack([[50, 50, 50], mean_stds[3:]])
+              n_components=100, n_jobs=1, seed=None):
+    """Fit the GMM head model to the feature files in `feature_dir`.
 
-    mean_means = means.mean(0)
-    print(mean_means)
-
-    sq_features = [squash_features(f, mean_means, use_stds) 
-                   for f in features]
-
-    # sample some people, sample some points
-    sample_ppl = np.random.permutation(len(features))[:n_ppl]
-    sample_inds = [np.random.permutation(len(features[ii]))[:n_pts] 
-                   for ii in sample_ppl]
+    The features are never all loaded at once: see `autocase3d.train`, where
+    `n_ppl` and `n_pts` set the size of the mini-batches of `train.fit_gmm`.
+    """
+    from . import train
 
-    sample_pts = np.vstack([sq_features[ii][pp] 
-                            for ii,pp in zip(sample_ppl, sample_inds)])
-    print(sample_pts.shape)
+    feature_files = [os.path.join(feature_dir, f) 
+                     for f in sorted(os.listdir(feature_dir))]
+    means, stds = train.feature_stats(feature_files, n_jobs=n_jobs)
+    print(means, stds)
 
     print("Fitting GMM..")
-    gmm = sklearn.mixture.GaussianMixture(n_components=n_components, verbose=1)
-    gmm.fit(sample_pts)
+    gmm = train.fit_gmm(feature_files, means, stds, n_components=n_components,
+                        n_ppl=n_ppl, n_pts=n_pts, seed=seed)
 
-    return gmm, mean_means, use_stds
+    return gmm, means, stds
 
 def squash_features(f, means, stds, which_tanh=(3,4,5)):
     new_f = f.copy()
@@ -86,6 +64,9 @@ def score(params, new_head, the_gmm):
     return -the_gmm.score(xfm_feats)
 
 def fit_xfm_fmin(infile, modelfile, init=(0,0,0,0,0,0), **fmin_kwargs):
+    import scipy.optimize
+    from .util import get_ply_features
+
     new_features, new_polys = get_ply_features(infile)
     gmm, means, stds = np.load(modelfile, encoding="bytes")
 
@@ -0,0 +1,93 @@
+"""On-disk caches shared by the pipeline stages.
+
+Entries are content-addressed: their file name is a hash of everything that
+determines their content, so a stale entry can never be returned. Each cache
+lives in its own subdirectory of `CACHE_DIR` and is bounded in size by
+evicting the least recently used entries.
+"""
+import contextlib
+import hashlib
+import os
+
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    "HEADCASE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "headcase-pipeline"),
+)
+
+
+def cache_dir(name):
+    """Return the directory of cache `name`, creating it if necessary."""
+    path = os.path.join(CACHE_DIR, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def hash_arrays(*arrays, **params):
+    """Hash the content, dtype and shape of `arrays` together with `params`."""
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(f"{array.dtype.str}{array.shape}".encode())
+        sha.update(array.data)
+    for key in sorted(params):
+        sha.update(f"{key}={params[key]!r}".encode())
+    return sha.hexdigest()
+
+
+def hash_file(path):
+    """Hash the content of the file at `path`."""
+    sha = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def touch(path):
+    """Mark a cache entry as recently used."""
+    os.utime(path)
+
+
+def evict_lru(directory, max_bytes):
+    """Remove the least recently used files until `directory` fits `max_bytes`."""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+@contextlib.contextmanager
+def atomic_path(path, suffix=""):
+    """Temporary path to write the file `path` to, renamed to `path` once the
+    block exits, so that readers never see a partial file.
+
+    The temporary file is removed if the block raises. `suffix` is appended to
+    the temporary path, for writers that need an extension.
+
+    Examples
+    --------
+    >>> with atomic_path("manifest.json") as tmp, open(tmp, "w") as fp:
+    ...     json.dump(manifest, fp)
+    """
+    tmp = f"{path}.{os.getpid()}.tmp{suffix}"
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def save_atomic(path, array):
+    """Save `array` as a .npy file so that readers never see a partial file."""
+    with atomic_path(path) as tmp, open(tmp, "wb") as fp:
+        np.save(fp, array)
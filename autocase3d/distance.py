@@ -0,0 +1,295 @@
+"""Distances from points to triangle meshes.
+
+The closest point of a mesh to many points is found by indexing the centers of
+small pieces of its triangles in a KD-tree: the triangles of the centers
+nearest to each point are candidates, and their exact closest points are
+computed at once with vectorized point-to-triangle queries. Every point of a
+piece is within `radius` of its center, so the candidates are known to contain
+the closest triangle when the farthest center queried is at least `radius`
+farther than the closest candidate. The other points query more centers, and
+then every center within that distance.
+
+Whether points are inside a mesh is found from the parity of the number of
+crossings of the mesh by vertical rays, with the triangles binned on a grid of
+the horizontal plane.
+"""
+import numpy as np
+
+# Numbers of samples queried for the points, until their closest triangle is
+# known to be among the triangles of the samples.
+N_NEIGHBORS = (32, 256)
+
+
+def closest_points_on_triangles(points, tris):
+    """Closest point of triangle `tris[i]` to `points[i]`, for every i.
+
+    This is the region test of Ericson, Real-Time Collision Detection (5.1.5),
+    evaluated for all the pairs at once.
+    """
+    a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+    ab, ac = b - a, c - a
+    ap, bp, cp = points - a, points - b, points - c
+    d1, d2 = _dot(ab, ap), _dot(ac, ap)
+    d3, d4 = _dot(ab, bp), _dot(ac, bp)
+    d5, d6 = _dot(ab, cp), _dot(ac, cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denom = va + vb + vc
+        closest = a + ab * (vb / denom)[:, None] + ac * (vc / denom)[:, None]
+        # from the lowest to the highest priority, as in Ericson's early returns
+        regions = [
+            (
+                (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0),
+                b + (c - b) * ((d4 - d3) / ((d4 - d3) + (d5 - d6)))[:, None],
+            ),
+            ((vb <= 0) & (d2 >= 0) & (d6 <= 0), a + ac * (d2 / (d2 - d6))[:, None]),
+            ((d6 >= 0) & (d5 <= d6), c),
+            ((vc <= 0) & (d1 >= 0) & (d3 <= 0), a + ab * (d1 / (d1 - d3))[:, None]),
+            ((d3 >= 0) & (d4 <= d3), b),
+            ((d1 <= 0) & (d2 <= 0), a),
+        ]
+    for inside, point in regions:
+        closest = np.where(inside[:, None], point, closest)
+    # degenerate triangles, whose closest point is on one of their edges
+    flat = np.flatnonzero(np.isnan(closest).any(1))
+    if len(flat):
+        closest[flat] = _closest_points_on_edges(points[flat], tris[flat])
+    return closest
+
+
+def _closest_points_on_edges(points, tris):
+    """Closest point of the edges of triangle `tris[i]` to `points[i]`."""
+    best, best_dist = None, None
+    for start, end in [(0, 1), (1, 2), (2, 0)]:
+        a, ab = tris[:, start], tris[:, end] - tris[:, start]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.clip(_dot(points - a, ab) / _dot(ab, ab), 0, 1)
+        point = a + ab * np.nan_to_num(t)[:, None]
+        dist = np.linalg.norm(points - point, axis=1)
+        if best is None:
+            best, best_dist = point, dist
+        else:
+            closer = dist < best_dist
+            best[closer], best_dist[closer] = point[closer], dist[closer]
+    return best
+
+
+def inside(points, pts, polys):
+    """Whether points are inside a closed triangle mesh.
+
+    Rays are cast from the points along z, and the points whose ray crosses the
+    mesh an odd number of times are inside. The rays are moved by a tiny amount
+    so that they do not go exactly through an edge or a vertex of the mesh.
+    """
+    points = np.asarray(points, dtype=np.double)
+    tris = np.asarray(pts, dtype=np.double)[polys]
+    low, high = tris[:, :, :2].min(1), tris[:, :, :2].max(1)
+    cell = max(np.median(high - low), 1e-6)
+    origin = low.min(0)
+    first = np.floor((low - origin) / cell).astype(int)
+    spans = np.floor((high - origin) / cell).astype(int) - first + 1
+    n_cells = first.max(0) + spans.max(0)
+
+    # cells overlapped by the bounding box of each triangle, sorted by cell
+    counts = spans.prod(1)
+    faces = np.repeat(np.arange(len(tris)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = first[faces, 0] + offset % spans[faces, 0]
+    y = first[faces, 1] + offset // spans[faces, 0]
+    cells = x * n_cells[1] + y
+    order = np.argsort(cells, kind="stable")
+    cells, faces = cells[order], faces[order]
+
+    xy = points[:, :2] + cell * 1e-7 * np.array([2**0.5, 3**0.5])
+    point_cells = np.floor((xy - origin) / cell).astype(int)
+    valid = ((point_cells >= 0) & (point_cells < n_cells)).all(1)
+    point_cells = point_cells[:, 0] * n_cells[1] + point_cells[:, 1]
+    start = np.searchsorted(cells, point_cells)
+    counts = np.where(valid, np.searchsorted(cells, point_cells, "right") - start, 0)
+    query = np.repeat(np.arange(len(points)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    faces = faces[np.repeat(start, counts) + offset]
+
+    # barycentric coordinates of the rays in the triangles projected on xy
+    a, b, c = tris[faces, 0], tris[faces, 1], tris[faces, 2]
+    xy = xy[query]
+    weights = np.column_stack([_edge(b, c, xy), _edge(c, a, xy), _edge(a, b, xy)])
+    area = weights.sum(1)
+    crossed = ((weights >= 0).all(1) | (weights <= 0).all(1)) & (area != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = _dot(weights, np.column_stack([a[:, 2], b[:, 2], c[:, 2]])) / area
+    crossed &= z > points[query, 2]
+    return np.bincount(query[crossed], minlength=len(points)) % 2 == 1
+
+
+def _edge(start, end, xy):
+    """Twice the signed area of the triangles (start, end, xy) in the xy plane."""
+    return (end[:, 0] - start[:, 0]) * (xy[:, 1] - start[:, 1]) - (
+        end[:, 1] - start[:, 1]
+    ) * (xy[:, 0] - start[:, 0])
+
+
+def _dot(x, y):
+    return np.einsum("ij,ij->i", x, y)
+
+
+def _sample_triangles(tris, spacing):
+    """Centers of the triangles subdivided into triangles whose edges are
+    shorter than `spacing`, the triangle of each center, and the largest
+    distance from a center to the corners of its sub-triangle.
+    """
+    edges = np.linalg.norm(tris - np.roll(tris, 1, axis=1), axis=2)
+    n_steps = np.maximum(np.ceil(edges.max(1) / spacing), 1).astype(int)
+    centroids = tris.mean(1)
+    radius = np.linalg.norm(tris - centroids[:, None], axis=2).max(1) / n_steps
+    samples, faces = [], []
+    for n in np.unique(n_steps):
+        # barycentric coordinates of the centers of the upward and downward
+        # sub-triangles of the regular subdivision with n steps along each edge
+        i, j = np.triu_indices(n)
+        i, j = j - i, n - 1 - j
+        up = np.column_stack([i, j]) + 1 / 3
+        down = up[i + j <= n - 2] + 1 / 3
+        bc = np.vstack([up, down]) / n
+        weights = np.column_stack([1 - bc.sum(1), bc])
+        selected = np.flatnonzero(n_steps == n)
+        samples.append(np.einsum("sk,tkd->tsd", weights, tris[selected]).reshape(-1, 3))
+        faces.append(np.repeat(selected, len(weights)))
+    return np.concatenate(samples), np.concatenate(faces), radius.max()
+
+
+def signed_distance(points, pts, polys, max_distance=np.inf, spacing=None):
+    """
+    Signed distance from points to a closed triangle mesh.
+
+    Parameters
+    ----------
+    points : array, shape (n_points, 3)
+        Query points.
+    pts : array, shape (n_vertices, 3)
+        Vertices of the mesh.
+    polys : array, shape (n_faces, 3)
+        Faces of the mesh, oriented outwards.
+    max_distance : float, optional
+        Points farther than this from the mesh may be given an infinite
+        distance, which is faster. Default is to compute all distances.
+    spacing : float, optional
+        Size of the pieces of the triangles indexed in the KD-tree. Default is
+        the median length of the edges of the mesh.
+
+    Returns
+    -------
+    distance : array, shape (n_points,)
+        Distance from each point to the mesh, positive outside of the mesh and
+        negative inside of it.
+    closest : array, shape (n_points, 3)
+        Closest point of the mesh to each point, NaN where the distance is
+        infinite.
+    """
+    from scipy.spatial import cKDTree
+
+    points = np.asarray(points, dtype=np.double)
+    tris = np.asarray(pts, dtype=np.double)[polys]
+    normals = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-300)[:, None]
+    if spacing is None:
+        spacing = np.median(np.linalg.norm(tris - np.roll(tris, 1, axis=1), axis=2))
+    samples, sample_faces, radius = _sample_triangles(tris, spacing)
+    tree = cKDTree(samples)
+
+    distance = np.full(len(points), np.inf)
+    closest = np.full((len(points), 3), np.nan)
+    pending = np.arange(len(points))
+    for k in N_NEIGHBORS:
+        k = min(k, len(samples))
+        sample_dist, sample_idx = tree.query(
+            points[pending],
+            k,
+            distance_upper_bound=max_distance + radius,
+            workers=-1,
+        )
+        sample_dist = sample_dist.reshape(len(pending), k)
+        sample_idx = sample_idx.reshape(len(pending), k)
+        # the distance to the triangle of the nearest sample bounds the
+        # distance of the samples of the closest triangle
+        bound = np.abs(distance[pending])
+        first = np.flatnonzero(sample_idx[:, 0] < len(samples))
+        point = points[pending[first]]
+        tri = tris[sample_faces[sample_idx[first, 0]]]
+        bound[first] = np.minimum(
+            bound[first],
+            np.linalg.norm(point - closest_points_on_triangles(point, tri), axis=1),
+        )
+        candidates = sample_dist <= bound[:, None] + radius
+        candidates &= sample_idx < len(samples)
+        query = np.repeat(pending, k)[candidates.ravel()]
+        faces = sample_faces[sample_idx[candidates]]
+        _update(distance, closest, *_closest(points, tris, normals, query, faces))
+        # the closest triangle has a sample within |distance| + radius
+        sure = sample_dist[:, -1] >= np.abs(distance[pending]) + radius
+        pending = pending[~sure & (k < len(samples))]
+        if not len(pending):
+            break
+    if len(pending):
+        neighbors = tree.query_ball_point(
+            points[pending], np.abs(distance[pending]) + radius, workers=-1
+        )
+        counts = np.array([len(n) for n in neighbors])
+        query = np.repeat(pending, counts)
+        faces = sample_faces[np.concatenate(neighbors).astype(int)]
+        _update(distance, closest, *_closest(points, tris, normals, query, faces))
+    return distance, closest
+
+
+def _update(distance, closest, query, new_distance, new_closest):
+    """Keep the new distances of the points `query` unless they are farther.
+
+    The candidate triangles of the new distances include those of the old ones,
+    so their sign is preferred for ties.
+    """
+    closer = np.abs(new_distance) <= np.abs(distance[query])
+    distance[query[closer]] = new_distance[closer]
+    closest[query[closer]] = new_closest[closer]
+
+
+def _closest(points, tris, normals, query, faces):
+    """Signed distance and closest point of candidate triangles `faces` to the
+    points `query`, keeping the closest candidate of each point.
+
+    Returns the indices of the points, and their signed distance and closest
+    point. The sign is given by the sum of the normals of the candidates whose
+    closest point is the closest one (e.g., the two faces of an edge), which is
+    correct where the closest point lies on an edge or a vertex.
+    """
+    # each candidate face once per point
+    order = np.lexsort([faces, query])
+    query, faces = query[order], faces[order]
+    unique = np.ones(len(query), dtype=bool)
+    unique[1:] = (query[1:] != query[:-1]) | (faces[1:] != faces[:-1])
+    query, faces = query[unique], faces[unique]
+    if not len(query):
+        return query, np.zeros(0), np.zeros((0, 3))
+
+    closest = closest_points_on_triangles(points[query], tris[faces])
+    dist = np.linalg.norm(points[query] - closest, axis=1)
+    new_point = np.ones(len(query), dtype=bool)
+    new_point[1:] = query[1:] != query[:-1]
+    starts = np.flatnonzero(new_point)
+    group = np.cumsum(new_point) - 1
+    best = np.minimum.reduceat(dist, starts)
+    nearest = np.flatnonzero(dist <= best[group] * (1 + 1e-9) + 1e-9)
+    normal = np.column_stack(
+        [
+            np.bincount(group[nearest], normals[faces[nearest], axis], len(starts))
+            for axis in range(3)
+        ]
+    )
+    first = nearest[np.unique(group[nearest], return_index=True)[1]]
+    query = query[starts]
+
+    sign = np.sign(_dot(points[query] - closest[first], normal))
+    sign[sign == 0] = 1
+    return query, sign * best, closest[first]
@@ -1,13 +1,34 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-import autograd.numpy as np
+import numpy as np
 import scipy.optimize
-from autograd import elementwise_grad, grad
-from autograd.numpy import cos, sin
-from sklearn.mixture import GaussianMixture
+from numpy import cos, sin
 
-from . import squash_features, unsquash_xyz
-from .util import get_ply_features
+from . import instrument, squash_features, unsquash_xyz
+from .util import get_features, get_ply_features, load_npz, voxel_subsample
+
+# Parameters of the GMM of head shape features.
+GMM_PARAMS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "gmm_params.npz"
+)
+
+# Number of samples evaluated at once by the GMM kernel. Each chunk holds an
+# (n_samples, n_components) array, so this bounds peak memory independently of
+# the scan resolution.
+CHUNK_SIZE = 4096
+
+# Default coarse-to-fine schedule for `fit_xfm_autograd`: number of points of
+# the spatially uniform subsample optimized at each level (None = all points).
+# The last level optimizes on the full mesh, so that the subsamples only speed
+# up the convergence and do not change the result.
+ALIGN_LEVELS = (2000, 20000, None)
+
+# Grid-search initialization: Euler angles tried for each rotation axis, and
+# number of vertices used to score every candidate.
+GRID_ANGLES = np.arange(-np.pi, np.pi, np.pi / 4)
+GRID_POINTS = 500
 
 
 def rot3(ph, th, ps):
@@ -33,70 +54,179 @@ def rot_trans(xyz, rots, trans):
     return np.dot(xyz, rmat) + trans
 
 
-def prob(params, new_feats, the_gmm):
-    rots = params[:3]
-    trans = params[3:]
+def _rot3_grad(ph, th, ps):
+    """Derivatives of `rot3` with respect to each of its angles.
 
-    rmat = rot3(rots[0], rots[1], rots[2])
+    Returns an array of shape (3, 3, 3) whose first axis indexes (ph, th, ps).
+    """
+    return np.array(
+        [
+            [
+                [
+                    0,
+                    sin(ph) * sin(ps) + cos(ph) * sin(th) * cos(ps),
+                    cos(ph) * sin(ps) - sin(ph) * sin(th) * cos(ps),
+                ],
+                [
+                    0,
+                    -sin(ph) * cos(ps) + cos(ph) * sin(th) * sin(ps),
+                    -cos(ph) * cos(ps) - sin(ph) * sin(th) * sin(ps),
+                ],
+                [0, cos(ph) * cos(th), -sin(ph) * cos(th)],
+            ],
+            [
+                [
+                    -sin(th) * cos(ps),
+                    sin(ph) * cos(th) * cos(ps),
+                    cos(ph) * cos(th) * cos(ps),
+                ],
+                [
+                    -sin(th) * sin(ps),
+                    sin(ph) * cos(th) * sin(ps),
+                    cos(ph) * cos(th) * sin(ps),
+                ],
+                [-cos(th), -sin(ph) * sin(th), -cos(ph) * sin(th)],
+            ],
+            [
+                [
+                    -cos(th) * sin(ps),
+                    -cos(ph) * cos(ps) - sin(ph) * sin(th) * sin(ps),
+                    sin(ph) * cos(ps) - cos(ph) * sin(th) * sin(ps),
+                ],
+                [
+                    cos(th) * cos(ps),
+                    -cos(ph) * sin(ps) + sin(ph) * sin(th) * cos(ps),
+                    sin(ph) * sin(ps) + cos(ph) * sin(th) * cos(ps),
+                ],
+                [0, 0, 0],
+            ],
+        ]
+    )
 
-    i63 = np.eye(6)[:3]
-    d6 = np.diag([0, 0, 0, 1, 1, 1])
 
-    big_rmat = np.dot(i63.T, np.dot(rmat, i63)) + d6
-    big_trans = np.dot(i63.T, trans)
-    xfm_feats = np.dot(new_feats, big_rmat) + big_trans
+def _transform_features(params, new_feats):
+    """Rigidly transform the xyz columns of `new_feats`, leaving curvatures."""
+    xfm_xyz = rot_trans(new_feats[:, :3], params[:3], params[3:])
+    return np.hstack([xfm_xyz, new_feats[:, 3:]])
+
+
+def prob(params, new_feats, the_gmm):
+    """Negative average log-likelihood of the transformed features."""
+    return -_score(_transform_features(params, new_feats), the_gmm)
 
-    return -np.log(
-        np.dot(
-            np.exp(
-                np.array(
-                    _estimate_log_gaussian_prob(
-                        xfm_feats, the_gmm.means_, the_gmm.precisions_cholesky_, "full"
-                    )
+
+def prob_and_grad(
+    params, new_feats, the_gmm, sample_weight=None, chunk_size=CHUNK_SIZE
+):
+    """Objective `prob` and its gradient with respect to `params`, in one pass.
+
+    The gradient of the log-likelihood with respect to each transformed point
+    is the responsibility-weighted sum of -P_k (x - mu_k) over the components;
+    it is then chained through the translation and the Euler angles of `rot3`.
+    Only the xyz columns are affected by the transform, so only those rows of
+    the precision matrices are used. If `sample_weight` is given, the
+    objective is the weighted average over the samples.
+    """
+    n_samples, n_features = new_feats.shape
+    if sample_weight is None:
+        sample_weight = np.ones(n_samples)
+    sample_weight = sample_weight / np.sum(sample_weight)
+    xyz = new_feats[:, :3]
+    xfm_feats = _transform_features(params, new_feats)
+
+    total_log_like = 0.0
+    dlike_dxyz = np.empty((n_samples, 3))
+    for start in range(0, n_samples, chunk_size):
+        feats = xfm_feats[start : start + chunk_size].astype(the_gmm.dtype, copy=False)
+        weighted_log_prob = _weighted_log_prob(feats, the_gmm)
+        log_like = _logsumexp(weighted_log_prob)
+        resp = np.exp(weighted_log_prob - log_like[:, np.newaxis])
+        weight = sample_weight[start : start + chunk_size]
+        total_log_like += np.dot(weight, log_like)
+
+        resp = resp * weight[:, np.newaxis].astype(the_gmm.dtype, copy=False)
+        resp_prec = np.dot(resp, the_gmm.prec_xyz_).reshape(len(feats), 3, n_features)
+        dlike_dxyz[start : start + chunk_size] = np.dot(
+            resp, the_gmm.prec_mu_xyz_
+        ) - np.einsum("nij,nj->ni", resp_prec, feats)
+
+    # objective is the negative (weighted) mean log-likelihood
+    dobj_dxyz = -dlike_dxyz
+    dobj_drmat = np.dot(xyz.T, dobj_dxyz)
+    grad_rots = np.einsum("aij,ij->a", _rot3_grad(*params[:3]), dobj_drmat)
+    grad_trans = dobj_dxyz.sum(0)
+
+    return -total_log_like, np.hstack([grad_rots, grad_trans])
+
+
+def _log_likelihood(X, the_gmm, chunk_size=CHUNK_SIZE):
+    """Per-sample log-likelihood of `X` under `the_gmm`.
+
+    The mixture is combined in log space (log-sum-exp over log-weights), so
+    points far away from every component do not underflow to -inf.
+    """
+    return np.concatenate(
+        [
+            _logsumexp(
+                _weighted_log_prob(
+                    X[start : start + chunk_size].astype(the_gmm.dtype, copy=False),
+                    the_gmm,
                 )
-            ).T,
-            the_gmm.weights_,
-        )
-    ).mean()
+            )
+            for start in range(0, len(X), chunk_size)
+        ]
+    ).astype(np.double)
 
 
-prob_grad = elementwise_grad(prob)
+def _logsumexp(a):
+    """Row-wise log(sum(exp(a))) that does not overflow or underflow."""
+    amax = np.max(a, axis=1, keepdims=True)
+    return np.log(np.sum(np.exp(a - amax), axis=1)) + amax[:, 0]
 
 
-def _estimate_log_gaussian_prob(X, means, precisions_chol, covariance_type):
-    """Estimate the log Gaussian probability.
-    Parameters
-    ----------
-    X : array-like, shape (n_samples, n_features)
-    means : array-like, shape (n_components, n_features)
-    precisions_chol : array-like
-        Cholesky decompositions of the precision matrices.
-        'full' : shape of (n_components, n_features, n_features)
-        'tied' : shape of (n_features, n_features)
-        'diag' : shape of (n_components, n_features)
-        'spherical' : shape of (n_components,)
-    covariance_type : {'full', 'tied', 'diag', 'spherical'}
+def _score(X, the_gmm):
+    """Average log-likelihood of `X`, equivalent to `GaussianMixture.score`."""
+    return np.mean(_log_likelihood(X, the_gmm))
+
+
+def _weighted_log_prob(X, the_gmm):
+    """Log-probability of `X` under each component, plus its log-weight.
+
+    All components are evaluated at once: the Mahalanobis distance
+    (x - mu)' P (x - mu), with P = precisions_chol . precisions_chol', is
+    expanded into quadratic, linear and constant terms in `x` (see
+    `_quadratic_coefficients`), so that the distances to every component come
+    out of a single (n_samples, n_terms) x (n_terms, n_components) matrix
+    product.
+
     Returns
     -------
     log_prob : array, shape (n_samples, n_components)
     """
     n_samples, n_features = X.shape
-    n_components, _ = means.shape
-    # det(precision_chol) is half of det(precision)
-    log_det = _compute_log_det_cholesky(precisions_chol, covariance_type, n_features)
+    rows, cols = np.triu_indices(n_features)
+    terms = np.concatenate(
+        [X[:, rows] * X[:, cols], X, np.ones((n_samples, 1), dtype=X.dtype)], axis=1
+    )
+    return the_gmm.log_norm_ - 0.5 * np.dot(terms, the_gmm.coefs_)
 
-    if covariance_type == "full":
-        # log_prob = np.empty((n_samples, n_components))
-        log_prob = []
-        for k, (mu, prec_chol) in enumerate(zip(means, precisions_chol)):
-            y = np.dot(X, prec_chol) - np.dot(mu, prec_chol)
-            log_prob.append(
-                -0.5 * (n_features * np.log(2 * np.pi) + np.sum(np.square(y), axis=1))
-                + log_det[k]
-            )
 
-    # return -.5 * (n_features * np.log(2 * np.pi) + log_prob) + log_det
-    return log_prob
+def _quadratic_coefficients(means, precisions_chol):
+    """Coefficients of the Mahalanobis distance as a polynomial in `x`.
+
+    Returns an array of shape (n_terms, n_components) matching the terms
+    [x_i * x_j for i <= j] + [x_i] + [1] used by `_weighted_log_prob`.
+    """
+    n_components, n_features, _ = precisions_chol.shape
+    precisions = np.einsum("kij,klj->kil", precisions_chol, precisions_chol)
+    rows, cols = np.triu_indices(n_features)
+    # off-diagonal terms appear twice in the symmetric quadratic form
+    quadratic = precisions[:, rows, cols] * np.where(rows == cols, 1.0, 2.0)
+    linear = -2 * np.einsum("kij,kj->ki", precisions, means)
+    constant = np.einsum("ki,ki->k", linear, means) / -2
+    return np.concatenate(
+        [quadratic, linear, constant[:, np.newaxis]], axis=1
+    ).T
 
 
 def _compute_log_det_cholesky(matrix_chol, covariance_type, n_features):
@@ -135,39 +265,409 @@ def _compute_log_det_cholesky(matrix_chol, covariance_type, n_features):
     return log_det_chol
 
 
-def _load_gmm_model():
-    """Load GMM model by loading the parameters and instantiating a GMM object."""
-    here = os.path.dirname(os.path.abspath(__file__))
-    model_file = os.path.join(here, "gmm_params.npz")
-    params = np.load(model_file)
-    means, stds = params["means"], params["stds"]
-    gmm = GaussianMixture()
-    for key, param in params.items():
-        if "gmm" in key:
-            attr = key.replace("gmm_", "")
-            setattr(gmm, attr, param)
-    return gmm, means, stds
+class GMM:
+    """Gaussian mixture of head shape features, as used by the alignment.
 
+    Only the parameters of the components used to evaluate the likelihood are
+    kept: means, Cholesky factors of the precision matrices, log-weights, and
+    the log-determinants of the Cholesky factors. The coefficients of the
+    Mahalanobis distances (see `_weighted_log_prob`), and the rows of the
+    precision matrices used by the gradient of `prob_and_grad`, are computed
+    once here rather than at every evaluation of the objective.
 
-def fit_xfm_autograd(infile, **fmin_kwargs):
-    new_features, new_polys = get_ply_features(infile)
-    gmm, means, stds = _load_gmm_model()
+    The parameters are stored, and the likelihood evaluated, with the dtype of
+    `precisions_cholesky` (float64 or float32), but the objective and its
+    gradient are accumulated in float64. Evaluating a float32 model is about
+    twice as fast, but its rounding errors (about 1e-4 on the objective) slow
+    down the convergence of the alignment.
+    """
+
+    def __init__(self, means, precisions_cholesky, log_weights, log_dets=None):
+        n_components, n_features, _ = precisions_cholesky.shape
+        dtype = precisions_cholesky.dtype
+        self.means_ = means
+        self.precisions_cholesky_ = precisions_cholesky
+        self.log_weights_ = log_weights
+        if log_dets is None:
+            log_dets = _compute_log_det_cholesky(
+                precisions_cholesky, "full", n_features
+            )
+        self.log_dets_ = log_dets
+
+        # derived terms, computed in float64
+        means = np.asarray(means, dtype=np.double)
+        precisions_chol = np.asarray(precisions_cholesky, dtype=np.double)
+        precisions = np.einsum("kij,klj->kil", precisions_chol, precisions_chol)
+        self.coefs_ = _quadratic_coefficients(means, precisions_chol).astype(dtype)
+        self.log_norm_ = (
+            log_weights + log_dets - 0.5 * n_features * np.log(2 * np.pi)
+        ).astype(dtype)
+        # rows of P_k and P_k mu_k that act on the xyz coordinates
+        self.prec_xyz_ = precisions[:, :3, :].reshape(n_components, -1).astype(dtype)
+        self.prec_mu_xyz_ = np.einsum(
+            "kij,kj->ki", precisions[:, :3, :], means
+        ).astype(dtype)
+
+    @classmethod
+    def from_sklearn(cls, gmm):
+        """Compact model of a fitted `sklearn.mixture.GaussianMixture` (or of
+        an object with its `weights_`, `means_` and `precisions_cholesky_`)."""
+        return cls(
+            np.asarray(gmm.means_),
+            np.asarray(gmm.precisions_cholesky_),
+            np.log(gmm.weights_),
+        )
+
+    @property
+    def dtype(self):
+        return self.precisions_cholesky_.dtype
+
+    @property
+    def n_components(self):
+        return len(self.log_weights_)
+
+    @property
+    def weights_(self):
+        return np.exp(np.asarray(self.log_weights_, dtype=np.double))
+
+    def astype(self, dtype):
+        """The same model, with its parameters stored as `dtype`."""
+        return GMM(
+            *(
+                np.asarray(param).astype(dtype)
+                for param in [
+                    self.means_,
+                    self.precisions_cholesky_,
+                    self.log_weights_,
+                    self.log_dets_,
+                ]
+            )
+        )
+
+    def prune(self, min_weight):
+        """The model without the components whose weight is below
+        `min_weight`, with the remaining weights scaled to sum to one."""
+        keep = self.weights_ >= min_weight
+        log_weights = np.asarray(self.log_weights_, dtype=np.double)[keep]
+        log_weights -= np.log(np.exp(log_weights).sum())
+        return GMM(
+            np.asarray(self.means_)[keep],
+            np.asarray(self.precisions_cholesky_)[keep],
+            log_weights.astype(self.dtype),
+            np.asarray(self.log_dets_)[keep],
+        )
+
+    def sample(self, n_samples, seed=0):
+        """Draw samples from the model."""
+        rng = np.random.default_rng(seed)
+        means = np.asarray(self.means_, dtype=np.double)
+        precisions_chol = np.asarray(self.precisions_cholesky_, dtype=np.double)
+        components = rng.choice(self.n_components, n_samples, p=self.weights_)
+        noise = rng.standard_normal((n_samples, means.shape[1]))
+        # x = mu + L'^-1 z has covariance (L L')^-1
+        offsets = np.linalg.solve(
+            np.swapaxes(precisions_chol[components], 1, 2), noise[..., np.newaxis]
+        )
+        return means[components] + offsets[..., 0]
+
+
+def save_gmm_model(path, gmm, means, stds):
+    """Save a `GMM` and the normalization of the features in the compact format.
+
+    The arrays are stored uncompressed, so that they can be memory-mapped by
+    `_load_gmm_model`.
+    """
+    np.savez(
+        path,
+        means=means,
+        stds=stds,
+        gmm_means_=gmm.means_,
+        gmm_precisions_cholesky_=gmm.precisions_cholesky_,
+        gmm_log_weights_=gmm.log_weights_,
+        gmm_log_dets_=gmm.log_dets_,
+    )
+
+
+def _load_gmm_model(path=GMM_PARAMS_FILE, dtype=None, mmap=False):
+    """Load the GMM of head shape features and the normalization of the features.
+
+    `path` is either a file of the parameters of a fitted
+    `sklearn.mixture.GaussianMixture` (such as `gmm_params.npz`), or a file in
+    the compact format of `save_gmm_model`, whose arrays are memory-mapped if
+    `mmap` is True. The parameters are converted to `dtype` if given.
+
+    Returns
+    -------
+    gmm : GMM
+    means, stds : array, shape (n_features,)
+        Normalization of the features, see `squash_features`.
+    """
+    params = load_npz(path, mmap=mmap)
+    if "gmm_log_weights_" in params:
+        gmm = GMM(
+            params["gmm_means_"],
+            params["gmm_precisions_cholesky_"],
+            params["gmm_log_weights_"],
+            params["gmm_log_dets_"],
+        )
+    else:
+        gmm = GMM(
+            params["gmm_means_"],
+            params["gmm_precisions_cholesky_"],
+            np.log(params["gmm_weights_"]),
+        )
+    if dtype is not None and gmm.dtype != dtype:
+        gmm = gmm.astype(dtype)
+    return gmm, np.asarray(params["means"]), np.asarray(params["stds"])
+
+
+def grid_candidates(
+    new_feats, the_gmm, angles=GRID_ANGLES, translations=(0.0,), n_points=GRID_POINTS
+):
+    """Score a grid of candidate transforms in one batched evaluation.
+
+    Every combination of `angles` for the three Euler angles is tried, keeping
+    the second angle within [-pi/2, pi/2] and dropping combinations that
+    describe the same rotation. For each rotation, the translation moves the
+    centroid of the rotated scan onto the centroid of the GMM, and is then
+    offset by every combination of `translations` (normalized units) along the
+    three axes. All candidates are scored at once on a voxel-grid subsample of
+    about `n_points` vertices.
+
+    Returns
+    -------
+    candidates : array, shape (n_candidates, 6)
+        Candidate parameters, sorted from best to worst.
+    scores : array, shape (n_candidates,)
+        Objective (`prob`) of each candidate on the subsample.
+    """
+    subset, counts = voxel_subsample(new_feats[:, :3], n_points)
+    feats = new_feats[subset]
+    weights = counts / counts.sum()
+
+    angles = np.asarray(angles)
+    tilts = angles[np.abs(angles) <= np.pi / 2]
+    rots = np.stack(np.meshgrid(angles, tilts, angles, indexing="ij"), -1)
+    rots = rots.reshape(-1, 3)
+    # rot3 broadcasts over arrays of angles: (3, 3, n_rots) -> (n_rots, 3, 3)
+    rmats = np.moveaxis(rot3(rots[:, 0], rots[:, 1], rots[:, 2]), -1, 0)
+    _, unique = np.unique(
+        np.round(rmats.reshape(len(rots), -1), 6), axis=0, return_index=True
+    )
+    rots, rmats = rots[np.sort(unique)], rmats[np.sort(unique)]
+
+    offsets = np.stack(
+        np.meshgrid(translations, translations, translations, indexing="ij"), -1
+    ).reshape(-1, 3)
+    rot_xyz = np.einsum("mi,rij->rmj", feats[:, :3], rmats)
+    gmm_center = np.dot(the_gmm.weights_, the_gmm.means_[:, :3])
+    centering = gmm_center - np.dot(weights, rot_xyz)
+
+    trans = (centering[:, np.newaxis] + offsets).reshape(-1, 3)
+    candidates = np.hstack([np.repeat(rots, len(offsets), axis=0), trans])
+    xfm_xyz = np.repeat(rot_xyz, len(offsets), axis=0) + trans[:, np.newaxis]
+    xfm_feats = np.concatenate(
+        [xfm_xyz, np.broadcast_to(feats[:, 3:], xfm_xyz.shape[:2] + (3,))], axis=2
+    )
+    log_like = _log_likelihood(xfm_feats.reshape(-1, new_feats.shape[1]), the_gmm)
+    scores = -np.dot(log_like.reshape(len(candidates), -1), weights)
+
+    order = np.argsort(scores)
+    return candidates[order], scores[order]
+
+
+def _fit_levels(sq_feats, the_gmm, init, levels, **fmin_kwargs):
+    """Run the coarse-to-fine optimization from `init`.
+
+    Returns the optimal parameters, the objective at the last level, and the
+    statistics of the solver at each level (number of points, iterations and
+    evaluations of the objective, time taken).
+    """
+    opt_params = np.asarray(init, dtype=float)
+    stats = []
+    for n_points in levels:
+        subset, counts = voxel_subsample(sq_feats[:, :3], n_points)
+        print(f"Optimizing alignment on {len(subset)} points")
+        start = time.perf_counter()
+        result = scipy.optimize.minimize(
+            prob_and_grad,
+            opt_params,
+            args=(sq_feats[subset], the_gmm, counts),
+            method="BFGS",
+            jac=True,
+            options=dict(dict(disp=True), **fmin_kwargs),
+        )
+        opt_params = result.x
+        stats.append(
+            dict(
+                n_points=len(subset),
+                nit=int(result.nit),
+                nfev=int(result.nfev),
+                njev=int(result.njev),
+                fun=float(result.fun),
+                success=bool(result.success),
+                seconds=time.perf_counter() - start,
+            )
+        )
+    return opt_params, result.fun, stats
+
+
+def fit_xfm_autograd(
+    infile,
+    levels=ALIGN_LEVELS,
+    grid_search=True,
+    n_starts=3,
+    n_jobs=1,
+    gmm_file=GMM_PARAMS_FILE,
+    init=None,
+    init_offset=None,
+    init_max_score=None,
+    **fmin_kwargs,
+):
+    """Rigidly align a cleaned head scan to the GMM head model.
+
+    Parameters
+    ----------
+    infile : str or tuple of arrays
+        Path to the cleaned head model (.ply), or its vertices and faces.
+    levels : sequence of int or None, optional
+        Coarse-to-fine schedule. At each level the transform is optimized on a
+        voxel-grid subsample of about that many vertices, starting from the
+        result of the previous level; None optimizes on all vertices. Each
+        subsampled vertex is weighted by the number of vertices in its voxel,
+        so the cost of alignment is set by these sizes rather than by the
+        resolution of the scan, while the objective still approximates the
+        full-resolution one. Every starting point is optimized on all the
+        levels but the last one, and only the best of them is then refined on
+        the last level. The default, `ALIGN_LEVELS`, ends with None, so the
+        result is optimized on the full mesh; on synthetic head scans, the
+        subsampled levels alone matched it to about 2e-3 (0.1 degree, 0.1 mm)
+        whenever both converged to the same minimum.
+    grid_search : bool, optional
+        If True (default), score a grid of candidate head orientations with
+        `grid_candidates` and refine the best `n_starts` of them, in addition
+        to the identity transform. Otherwise, only start from the identity.
+    n_starts : int, optional
+        Number of grid candidates to refine. Default is 3.
+    n_jobs : int, optional
+        Number of processes used to refine the starting points in parallel.
+        Default is 1.
+    gmm_file : str, optional
+        GMM head model, either `GMM_PARAMS_FILE` (default) or a file written
+        by `save_gmm_model` (e.g., with `compact_gmm.py`). It is evaluated in
+        float64 even if stored as float32.
+    init : array, shape (6,), optional
+        Parameters of a previous alignment of the same head (e.g., stored by
+        `transforms.save_transform`), refined before the other starting points.
+    init_offset : array, shape (3,), optional
+        Displacement (in mm) of this scan from the scan aligned by `init`,
+        which `init` is corrected for.
+    init_max_score : float, optional
+        If the score of the alignment refined from `init` on all the levels but
+        the last one is at most this, it is kept, and the other starting points
+        are skipped.
+    **fmin_kwargs
+        Options passed to the BFGS solver of `scipy.optimize.minimize`.
+
+    Returns
+    -------
+    new_pts : array, shape (n_vertices, 3)
+        Aligned vertex coordinates.
+    new_polys : array, shape (n_faces, 3)
+        Faces of the scan.
+    opt_params : array, shape (6,)
+        Optimal rotation angles and translation (in normalized units).
+    final_score : float
+        Objective (`prob`) of the alignment on all the vertices.
+    """
+    levels = tuple(levels)
+    if not levels:
+        raise ValueError("The alignment schedule `levels` must not be empty")
+    # the starting points are compared on the coarse levels, and only the best
+    # one is refined on the last level, which is the most expensive
+    coarse, fine = (levels[:-1], levels[-1:]) if len(levels) > 1 else (levels, ())
+    with instrument.timed("step", "features") as event:
+        if isinstance(infile, str):
+            new_features, new_polys = get_ply_features(infile)
+        else:
+            new_features, new_polys = get_features(*infile)
+        event["n_vertices"] = len(new_features)
+    # float32 rounding errors make the line searches of BFGS fail, and cost
+    # more evaluations than they save
+    gmm, means, stds = _load_gmm_model(gmm_file, dtype=np.double, mmap=True)
 
     sq_new_features = squash_features(new_features, means, stds)
 
-    init_score = -gmm.score(sq_new_features)
+    init_score = -_score(sq_new_features, gmm)
     print("Init score:", init_score)
     if init_score > 6.0:  # ~?
         print("This looks wildly mis-aligned. Check results.")
 
-    opt_params = scipy.optimize.fmin_bfgs(
-        prob, np.zeros(6), prob_grad, args=(sq_new_features, gmm), **fmin_kwargs
-    )
+    warm_starts, warm_fits = [], []
+    accepted = False
+    if init is not None:
+        init = np.array(init, dtype=float)
+        if init_offset is not None:
+            shift = np.asarray(init_offset) / stds[:3]
+            init[3:] -= np.dot(shift, rot3(*init[:3]))
+        with instrument.timed("step", "warm_start") as event:
+            warm_fits.append(
+                _fit_levels(sq_new_features, gmm, init, coarse, **fmin_kwargs)
+            )
+            warm_score = prob(warm_fits[0][0], sq_new_features, gmm)
+            event["score"] = float(warm_score)
+        print("Warm start score:", warm_score)
+        warm_starts.append(init)
+        accepted = init_max_score is not None and warm_score <= init_max_score
+
+    starts = [] if accepted else [np.zeros(6)]
+    if grid_search and not accepted:
+        with instrument.timed("step", "grid_search") as event:
+            candidates, scores = grid_candidates(sq_new_features, gmm)
+            event["n_candidates"] = len(candidates)
+        print(f"Best grid candidates (of {len(candidates)}): {scores[:n_starts]}")
+        starts.extend(candidates[:n_starts])
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            futures = [
+                pool.submit(
+                    _fit_levels, sq_new_features, gmm, start, coarse, **fmin_kwargs
+                )
+                for start in starts
+            ]
+            fits = [future.result() for future in futures]
+    else:
+        fits = [
+            _fit_levels(sq_new_features, gmm, start, coarse, **fmin_kwargs)
+            for start in starts
+        ]
+    starts, fits = warm_starts + starts, warm_fits + fits
+    for start, (_, fun, stats) in zip(starts, fits):
+        instrument.record(
+            "optimizer", "bfgs", init=start.tolist(), fun=float(fun), levels=stats
+        )
+    opt_params, _, _ = min(fits, key=lambda fit: fit[1])
+    if fine:
+        start = opt_params
+        opt_params, fun, stats = _fit_levels(
+            sq_new_features, gmm, start, fine, **fmin_kwargs
+        )
+        instrument.record(
+            "optimizer", "bfgs", init=start.tolist(), fun=float(fun), levels=stats
+        )
 
     new_xyz = rot_trans(sq_new_features[:, :3], opt_params[:3], opt_params[3:])
-    final_score = -gmm.score(np.hstack([new_xyz, sq_new_features[:, 3:]]))
+    final_score = -_score(np.hstack([new_xyz, sq_new_features[:, 3:]]), gmm)
     print("Final score:", final_score)
+    instrument.record(
+        "optimizer",
+        "scores",
+        init_score=float(init_score),
+        final_score=float(final_score),
+        n_starts=len(starts),
+    )
 
     unsq_new_xyz = unsquash_xyz(new_xyz, means, stds)
 
-    return unsq_new_xyz, new_polys, opt_params
+    return unsq_new_xyz, new_polys, opt_params, final_score
@@ -0,0 +1,106 @@
+"""Timing, memory and solver statistics of the pipeline.
+
+The stages of the pipeline record events in this module: `timed` blocks
+measure their wall time, CPU time (of the process and of the subprocesses it
+waited for, such as Blender) and peak resident memory, and `record` adds
+statistics such as optimizer iteration counts or mesh sizes. Each timed block
+also prints a log line. The events of a run can then be written as a JSON
+report with `write_report`.
+"""
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+_events = []
+# Records of the timed blocks that are running, outermost first.
+_running = []
+
+
+def reset():
+    """Forget the recorded events."""
+    del _events[:]
+
+
+def events():
+    """Return the recorded events, oldest first."""
+    return list(_events)
+
+
+def record(kind, name, **info):
+    """Record an event of `kind` (e.g., "stage" or "optimizer") named `name`."""
+    event = dict(kind=kind, name=name, **info)
+    _events.append(event)
+    return event
+
+
+def _peak_rss():
+    """Peak resident memory (in MB) of the process since the last reset."""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory to the current one, where supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def _cpu_times():
+    """CPU time (in seconds) of the process and of its waited-for children."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time(), children.ru_utime + children.ru_stime
+
+
+@contextmanager
+def timed(kind, name, **info):
+    """Record the wall time, CPU time and peak memory of a block of code.
+
+    The event is recorded when the block starts, and is yielded so that the
+    block can add its own statistics to it. The peak memory of a block is
+    measured from its start on Linux, and since the start of the process
+    elsewhere.
+    """
+    event = record(kind, name, **info)
+    peak = _peak_rss()
+    for parent in _running:
+        parent["peak_rss_mb"] = max(parent["peak_rss_mb"], peak)
+    _reset_peak_rss()
+    event["peak_rss_mb"] = _peak_rss()
+    _running.append(event)
+    cpu, child_cpu = _cpu_times()
+    start = time.perf_counter()
+    try:
+        yield event
+    finally:
+        end_cpu, end_child_cpu = _cpu_times()
+        event["seconds"] = time.perf_counter() - start
+        event["cpu_seconds"] = end_cpu - cpu
+        event["child_cpu_seconds"] = end_child_cpu - child_cpu
+        _running.pop()
+        event["peak_rss_mb"] = max(event["peak_rss_mb"], _peak_rss())
+        for parent in _running:
+            parent["peak_rss_mb"] = max(parent["peak_rss_mb"], event["peak_rss_mb"])
+        print(
+            f"[{kind}] {name}: {event['seconds']:.2f} s, "
+            f"cpu {event['cpu_seconds'] + event['child_cpu_seconds']:.2f} s, "
+            f"peak memory {event['peak_rss_mb']:.0f} MB"
+        )
+
+
+def write_report(path, **info):
+    """Write the recorded events, and `info` about the run, as JSON."""
+    with open(path, "w") as fp:
+        json.dump(dict(info, events=_events), fp, indent=2, default=str)
@@ -0,0 +1,302 @@
+"""Train the GMM head model on many aligned head scans.
+
+The features of the scans (see `util.get_features`) are extracted by a pool of
+processes into one file per scan, named by the hash of the scan, so that scans
+whose features were already extracted are skipped. The model is then fitted
+without ever loading all the features:
+
+1. the normalization of the features (see `squash_features`) is computed from
+   the mean and standard deviation of each scan, one scan at a time, and
+2. the GMM is fitted by stepwise EM (Cappe and Moulines, 2009) on mini-batches
+   of a few points from each of a few scans. The sufficient statistics of the
+   components are a running average of those of the mini-batches, with a
+   decaying step size, and the parameters are updated from them after each
+   mini-batch.
+
+The resulting model can be saved in the format of `gmm_params.npz` with
+`save_gmm_params`.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import cache, squash_features
+from .fmin_autograd import CHUNK_SIZE, GMM, _logsumexp, _score, _weighted_log_prob
+from .util import FEATURE_CACHE_VERSION, load_npz, save_stl_features
+
+# Spatial scale of the normalized features, the same for the three coordinates.
+XYZ_SCALE = 50.0
+
+# Parameters saved in `gmm_params.npz`, as attributes of a fitted
+# `sklearn.mixture.GaussianMixture`.
+GMM_PARAMS = [
+    "weights_",
+    "means_",
+    "covariances_",
+    "precisions_",
+    "precisions_cholesky_",
+    "converged_",
+    "n_iter_",
+    "lower_bound_",
+]
+
+
+def _extract_one(stl_file, feature_dir, smooths):
+    """Extract the features of one scan, unless they already were.
+
+    Returns the path of the feature file, and whether it was written.
+    """
+    key = cache.hash_arrays(
+        scan=cache.hash_file(stl_file),
+        smooths=list(smooths),
+        version=FEATURE_CACHE_VERSION,
+    )
+    feature_file = os.path.join(feature_dir, key + ".npz")
+    if os.path.exists(feature_file):
+        return feature_file, False
+    save_stl_features(stl_file, feature_file, smooths, use_cache=False)
+    return feature_file, True
+
+
+def extract_features(stl_files, feature_dir, n_jobs=1, smooths=(5, 20, 200)):
+    """Extract the features of aligned scans into `feature_dir`.
+
+    Each scan is saved by `util.save_stl_features` in a file named by the hash
+    of its content, and skipped if that file exists. Scans that fail are
+    reported and left out.
+
+    Returns
+    -------
+    feature_files : list of str
+        Feature files of the scans, in the order of `stl_files`, without
+        duplicates.
+    """
+    os.makedirs(feature_dir, exist_ok=True)
+    feature_files = []
+    n_extracted = 0
+    with ProcessPoolExecutor(n_jobs) as pool:
+        futures = [
+            pool.submit(_extract_one, stl_file, feature_dir, smooths)
+            for stl_file in stl_files
+        ]
+        for stl_file, future in zip(stl_files, futures):
+            try:
+                feature_file, extracted = future.result()
+            except Exception as exc:
+                print(f"Could not extract the features of {stl_file}: {exc!r}")
+                continue
+            n_extracted += extracted
+            if feature_file in feature_files:
+                print(f"{stl_file} is a duplicate, skipping it")
+                continue
+            feature_files.append(feature_file)
+    print(
+        f"Extracted the features of {n_extracted} scans, and reused those of "
+        f"{len(feature_files) - n_extracted}"
+    )
+    return feature_files
+
+
+def _load_features(feature_file):
+    return load_npz(feature_file, mmap=True)["features"]
+
+
+def _scan_stats(feature_file):
+    features = _load_features(feature_file)
+    return features.mean(0), features.std(0)
+
+
+def feature_stats(feature_files, n_jobs=1):
+    """Normalization of the features, from one scan at a time.
+
+    The means are the average of the means of each scan, and the scales the
+    average of their standard deviations, except for the coordinates, which
+    are all scaled by `XYZ_SCALE`.
+
+    Returns
+    -------
+    means, stds : array, shape (n_features,)
+    """
+    total_mean = total_std = 0.0
+    with ProcessPoolExecutor(n_jobs) as pool:
+        for mean, std in pool.map(_scan_stats, feature_files, chunksize=16):
+            total_mean = total_mean + mean
+            total_std = total_std + std
+    means = total_mean / len(feature_files)
+    stds = total_std / len(feature_files)
+    stds[:3] = XYZ_SCALE
+    return means, stds
+
+
+def _sample_batch(feature_files, means, stds, n_pts, rng):
+    """Normalized features of `n_pts` random vertices of each scan."""
+    batch = []
+    for feature_file in feature_files:
+        features = _load_features(feature_file)
+        rows = np.sort(rng.permutation(len(features))[:n_pts])
+        batch.append(squash_features(np.asarray(features[rows]), means, stds))
+    return np.vstack(batch)
+
+
+def _batch_stats(X, gmm):
+    """Averages over `X` of the responsibilities of the components, of the
+    responsibilities times `X`, and of the responsibilities times the outer
+    products of `X`."""
+    n_samples, n_features = X.shape
+    s0 = np.zeros(gmm.n_components)
+    s1 = np.zeros((gmm.n_components, n_features))
+    s2 = np.zeros((gmm.n_components, n_features * n_features))
+    for start in range(0, n_samples, CHUNK_SIZE):
+        chunk = X[start : start + CHUNK_SIZE]
+        weighted_log_prob = _weighted_log_prob(chunk, gmm)
+        log_like = _logsumexp(weighted_log_prob)
+        resp = np.exp(weighted_log_prob - log_like[:, np.newaxis])
+        s0 += resp.sum(0)
+        s1 += np.dot(resp.T, chunk)
+        outer = chunk[:, :, np.newaxis] * chunk[:, np.newaxis, :]
+        s2 += np.dot(resp.T, outer.reshape(len(chunk), -1))
+    return (
+        s0 / n_samples,
+        s1 / n_samples,
+        s2.reshape(-1, n_features, n_features) / n_samples,
+    )
+
+
+def _m_step(s0, s1, s2, reg_covar):
+    """Weights, means and covariances of the components from their sufficient
+    statistics."""
+    s0 = s0 + 10 * np.finfo(s0.dtype).eps
+    weights = s0 / s0.sum()
+    means = s1 / s0[:, np.newaxis]
+    covariances = s2 / s0[:, np.newaxis, np.newaxis] - np.einsum(
+        "ki,kj->kij", means, means
+    )
+    covariances += reg_covar * np.eye(means.shape[1])
+    return weights, means, covariances
+
+
+def _precisions_cholesky(covariances):
+    """Upper triangular Cholesky factors of the precisions, as in sklearn."""
+    try:
+        cov_chol = np.linalg.cholesky(covariances)
+    except np.linalg.LinAlgError:
+        raise ValueError(
+            "Fitting the GMM failed because some components have an ill-defined "
+            "covariance. Decrease the number of components, or increase reg_covar."
+        )
+    return np.swapaxes(np.linalg.inv(cov_chol), 1, 2)
+
+
+def fit_gmm(
+    feature_files,
+    means,
+    stds,
+    n_components=200,
+    n_ppl=50,
+    n_pts=1000,
+    max_epochs=20,
+    tol=1e-3,
+    step_decay=0.6,
+    reg_covar=1e-6,
+    seed=None,
+):
+    """Fit a GMM to the features of many scans by stepwise EM.
+
+    Parameters
+    ----------
+    feature_files : list of str
+        Feature files of the scans, as written by `extract_features`.
+    means, stds : array, shape (n_features,)
+        Normalization of the features, see `feature_stats`.
+    n_components : int, optional
+        Number of components. Default is 200.
+    n_ppl, n_pts : int, optional
+        Each mini-batch has `n_pts` random vertices of each of `n_ppl` scans.
+        Default is 50 scans and 1000 vertices. The model is initialized by a
+        regular EM fit on the first mini-batch.
+    max_epochs : int, optional
+        Largest number of passes over the scans, with new random vertices at
+        every pass. Default is 20.
+    tol : float, optional
+        The fit stops when the average log-likelihood of a fixed sample of
+        points, drawn like a mini-batch, changes by less than this over a pass.
+        Default is 1e-3.
+    step_decay : float, optional
+        The statistics of the t-th mini-batch are given a weight (t + 2) **
+        -step_decay in the running averages, between 0.5 and 1 (the slowest
+        decay). Default is 0.6.
+    reg_covar : float, optional
+        Added to the diagonal of the covariances. Default is 1e-6.
+    seed : int, optional
+        Seed of the random selection of scans and vertices.
+
+    Returns
+    -------
+    gmm : sklearn.mixture.GaussianMixture
+        The fitted model, with the attributes saved by `save_gmm_params`.
+    """
+    import sklearn.mixture
+
+    rng = np.random.default_rng(seed)
+    n_ppl = min(n_ppl, len(feature_files))
+    order = rng.permutation(len(feature_files))
+    files = [feature_files[i] for i in order[:n_ppl]]
+    X = _sample_batch(files, means, stds, n_pts, rng)
+    files = [feature_files[i] for i in order[-n_ppl:]]
+    X_monitor = _sample_batch(files, means, stds, n_pts, rng)
+    print(f"Initializing the GMM on {len(X)} points")
+    init = sklearn.mixture.GaussianMixture(
+        n_components,
+        reg_covar=reg_covar,
+        random_state=int(rng.integers(2**31)),
+    ).fit(X)
+    weights, gmm_means, covariances = init.weights_, init.means_, init.covariances_
+    s0 = weights
+    s1 = weights[:, np.newaxis] * gmm_means
+    s2 = weights[:, np.newaxis, np.newaxis] * (
+        covariances + np.einsum("ki,kj->kij", gmm_means, gmm_means)
+    )
+    precisions_chol = init.precisions_cholesky_
+
+    step = 0
+    lower_bound = -np.inf
+    for epoch in range(1, max_epochs + 1):
+        order = rng.permutation(len(feature_files))
+        for start in range(0, len(order), n_ppl):
+            files = [feature_files[i] for i in order[start : start + n_ppl]]
+            X = _sample_batch(files, means, stds, n_pts, rng)
+            gmm = GMM(gmm_means, precisions_chol, np.log(weights))
+            batch = _batch_stats(X, gmm)
+            rate = (step + 2) ** -step_decay
+            s0, s1, s2 = (
+                (1 - rate) * old + rate * new for old, new in zip((s0, s1, s2), batch)
+            )
+            weights, gmm_means, covariances = _m_step(s0, s1, s2, reg_covar)
+            precisions_chol = _precisions_cholesky(covariances)
+            step += 1
+        gmm = GMM(gmm_means, precisions_chol, np.log(weights))
+        epoch_log_like = _score(X_monitor, gmm)
+        print(f"Epoch {epoch}: average log-likelihood {epoch_log_like:.4f}")
+        converged = abs(epoch_log_like - lower_bound) < tol
+        lower_bound = epoch_log_like
+        if converged:
+            break
+
+    gmm = sklearn.mixture.GaussianMixture(n_components, reg_covar=reg_covar)
+    gmm.weights_ = weights
+    gmm.means_ = gmm_means
+    gmm.covariances_ = covariances
+    gmm.precisions_cholesky_ = precisions_chol
+    gmm.precisions_ = np.einsum("kij,klj->kil", precisions_chol, precisions_chol)
+    gmm.converged_ = converged
+    gmm.n_iter_ = epoch
+    gmm.lower_bound_ = lower_bound
+    return gmm
+
+
+def save_gmm_params(path, gmm, means, stds):
+    """Save a fitted GMM and the normalization of the features in the format of
+    `gmm_params.npz`."""
+    params = {"gmm_" + param: getattr(gmm, param) for param in GMM_PARAMS}
+    np.savez(path, means=means, stds=stds, **params)
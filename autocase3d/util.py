@@ -1,33 +1,509 @@
+import os
+import re
+import warnings
+
 import numpy as np
-import cortex
-import plyfile
+
+from . import cache
+
+# Bound on the disk space used by cached curvature features.
+FEATURE_CACHE_MAX_BYTES = 1 << 30
+# Version of the cached curvature features, to bump when computing them changes
+# so that the features cached by previous versions are not used.
+FEATURE_CACHE_VERSION = 1
+
+# Size of the blocks of lines parsed at once by `read_obj`.
+OBJ_BLOCK_BYTES = 1 << 24
+
+# Numpy types of the PLY property types.
+PLY_TYPES = dict(
+    char="i1", uchar="u1", short="i2", ushort="u2", int="i4", uint="u4",
+    float="f4", double="f8", int8="i1", uint8="u1", int16="i2", uint16="u2",
+    int32="i4", uint32="u4", float32="f4", float64="f8",
+)
+
+# One triangle of a binary STL file.
+STL_DTYPE = np.dtype(
+    [("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attr", "<u2")]
+)
+
 
 def load_ply(ply_file):
+    """Read the vertices and faces of a PLY file.
+
+    Binary files whose faces are all triangles are memory-mapped and read as
+    structured arrays; other files (ASCII, polygons) are read with plyfile, and
+    their polygons are split into triangles.
+    """
+    mesh = _map_ply(ply_file)
+    if mesh is not None:
+        return mesh
+
+    import plyfile
+
     plydata = plyfile.PlyData.read(ply_file)
     vertex = plydata.elements[0]
     pts = np.vstack([vertex['x'], vertex['y'], vertex['z']]).T
 
     face = plydata.elements[1]
-    polys = np.vstack(face.data['vertex_indices'])
-    
+    polys = face.data['vertex_indices']
+    sizes = np.array([len(poly) for poly in polys])
+    polys = _triangulate(np.concatenate(polys).astype(np.int64), sizes)
+
     return pts, polys
 
-def get_features(pts, polys, smooths=[5, 20, 200]):
-    surf = cortex.polyutils.Surface(pts, polys)
-    curv = np.nan_to_num(surf.mean_curvature())
-    sm_curvs = np.vstack([surf.smooth(curv, factor=sm, iterations=3) 
-                         for sm in smooths])
-    
-    return np.hstack([pts, sm_curvs.T]), polys
+def _map_ply(ply_file):
+    """Memory-map a binary PLY file of triangles, or return None if it is not one."""
+    with open(ply_file, "rb") as fp:
+        if fp.readline().strip() != b"ply":
+            raise ValueError(f"{ply_file} is not a PLY file")
+        elements = []
+        for line in iter(fp.readline, b""):
+            words = line.decode("ascii", "replace").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "format":
+                byteorder = dict(
+                    binary_little_endian="<", binary_big_endian=">"
+                ).get(words[1])
+                if byteorder is None:
+                    return None
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property":
+                if words[1] == "list":
+                    # a list of 3 items, checked below
+                    count, item = PLY_TYPES[words[2]], PLY_TYPES[words[3]]
+                    elements[-1][2].append((words[4] + "_count", byteorder + count))
+                    elements[-1][2].append((words[4], byteorder + item, (3,)))
+                else:
+                    elements[-1][2].append((words[2], byteorder + PLY_TYPES[words[1]]))
+            elif words[0] == "end_header":
+                break
+        offset = fp.tell()
+
+    arrays = {}
+    for name, count, props in elements[:2]:
+        arrays[name] = np.memmap(
+            ply_file, dtype=np.dtype(props), mode="r", offset=offset, shape=(count,)
+        )
+        offset += count * arrays[name].dtype.itemsize
+    if set(arrays) != {"vertex", "face"} or len(arrays["face"].dtype) != 2:
+        return None
+    face = arrays["face"]
+    if offset > os.path.getsize(ply_file) or (face[face.dtype.names[0]] != 3).any():
+        return None
+    vertex = arrays["vertex"]
+    pts = np.column_stack([vertex["x"], vertex["y"], vertex["z"]]).astype(np.double)
+    return pts, face[face.dtype.names[1]].astype(np.int64)
+
+def read_stl(stl_file):
+    """Read an STL file, merging the vertices shared by its triangles.
+
+    Binary files are memory-mapped, and other files are read as ASCII STL.
+    """
+    with open(stl_file, "rb") as fp:
+        fp.seek(80)
+        n_faces = int(np.frombuffer(fp.read(4).ljust(4, b"\0"), dtype="<u4")[0])
+    if os.path.getsize(stl_file) == 84 + 50 * n_faces:
+        if n_faces == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+        records = np.memmap(
+            stl_file, dtype=STL_DTYPE, mode="r", offset=84, shape=(n_faces,)
+        )
+        corners = records["vertices"].reshape(-1, 3)
+    else:
+        corners = _read_ascii_stl(stl_file)
+    pts, polys = unique_rows(corners)
+    return pts.astype(np.double), polys.reshape(-1, 3)
+
+def _read_ascii_stl(stl_file):
+    """Corners of the triangles of an ASCII STL file."""
+    with open(stl_file, "rb") as fp:
+        text = fp.read()
+    if not text.lstrip().startswith(b"solid"):
+        raise ValueError(f"{stl_file} is not an STL file")
+    vertices = re.findall(rb"^\s*vertex\s+(.*)$", text, re.M)
+    corners = _parse_numbers(b"\n".join(vertices), np.float32)
+    if corners is None or len(corners) != 3 * len(vertices) or len(vertices) % 3:
+        raise ValueError(f"Could not parse the ASCII STL file {stl_file}")
+    return corners.reshape(-1, 3)
+
+def unique_rows(rows):
+    """Unique rows of a float32 array, and the index of each row in them.
+
+    Equivalent to `np.unique(rows, axis=0, return_inverse=True)`, up to the
+    order of the unique rows, and several times faster: the rows are sorted by
+    the bits of their coordinates.
+    """
+    # adding 0 turns -0.0 into 0.0, which have different bits
+    bits = np.ascontiguousarray(rows, dtype=np.float32) + np.float32(0)
+    bits = bits.view(np.uint32)
+    order = np.lexsort(bits.T[::-1])
+    sorted_bits = bits[order]
+    first = np.ones(len(bits), dtype=bool)
+    first[1:] = (sorted_bits[1:] != sorted_bits[:-1]).any(axis=1)
+    inverse = np.empty(len(bits), dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    return sorted_bits[first].view(np.float32), inverse
+
+def write_stl(stl_file, pts, polys):
+    """Write a mesh to a binary STL file."""
+    tris = np.asarray(pts)[polys]
+    normals = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normals = np.nan_to_num(normals / np.linalg.norm(normals, axis=1)[:, None])
+    records = np.zeros(len(tris), dtype=STL_DTYPE)
+    records["normal"] = normals
+    records["vertices"] = tris
+    with open(stl_file, "wb") as fp:
+        fp.write(b"\0" * 80)
+        np.array([len(records)], dtype="<u4").tofile(fp)
+        records.tofile(fp)
+
+def write_ply(ply_file, pts, polys, colors=None):
+    """Write a mesh to a binary PLY file, with optional RGB vertex colors."""
+    vertex_dtype = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    if colors is not None:
+        vertex_dtype += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    vertices = np.zeros(len(pts), dtype=vertex_dtype)
+    for axis, name in enumerate("xyz"):
+        vertices[name] = pts[:, axis]
+    if colors is not None:
+        for channel, name in enumerate(["red", "green", "blue"]):
+            vertices[name] = colors[:, channel]
+    faces = np.zeros(len(polys), dtype=[("n", "u1"), ("vertices", "<i4", (3,))])
+    faces["n"] = 3
+    faces["vertices"] = polys
+    header = [
+        "ply",
+        "format binary_little_endian 1.0",
+        f"element vertex {len(pts)}",
+        "property float x",
+        "property float y",
+        "property float z",
+    ]
+    if colors is not None:
+        header += ["property uchar red", "property uchar green", "property uchar blue"]
+    header += [
+        f"element face {len(polys)}",
+        "property list uchar int vertex_indices",
+        "end_header",
+    ]
+    with open(ply_file, "wb") as fp:
+        fp.write(("\n".join(header) + "\n").encode("ascii"))
+        vertices.tofile(fp)
+        faces.tofile(fp)
+
+def load_npz(npz_file, mmap=False):
+    """Read the arrays of an .npz file as a dict.
+
+    With `mmap`, the arrays stored uncompressed (as written by `np.savez`) are
+    memory-mapped rather than read, so that processes loading the same file
+    share its pages.
+    """
+    import zipfile
+
+    if not mmap:
+        with np.load(npz_file) as npz:
+            return dict(npz)
+    arrays = {}
+    with zipfile.ZipFile(npz_file) as pkg, open(npz_file, "rb") as fp:
+        for info in pkg.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with pkg.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # the local header of the member precedes its data
+            fp.seek(info.header_offset + 26)
+            name_size, extra_size = np.frombuffer(fp.read(4), "<u2").tolist()
+            fp.seek(info.header_offset + 30 + name_size + extra_size)
+            if np.lib.format.read_magic(fp) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(fp)
+            else:
+                header = np.lib.format.read_array_header_2_0(fp)
+            shape, fortran_order, dtype = header
+            arrays[name] = np.memmap(
+                npz_file,
+                dtype=dtype,
+                mode="r",
+                offset=fp.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+def read_obj(fp):
+    """Read the vertices and faces of a Wavefront OBJ file.
+
+    `fp` is a binary file object, such as a member of a zip archive, which is
+    parsed in blocks. Texture coordinates, normals and materials are skipped,
+    and polygons are split into triangles.
+    """
+    pts, polys = [], []
+    tail = b""
+    for block in iter(lambda: fp.read(OBJ_BLOCK_BYTES), b""):
+        block = tail + block
+        end = block.rfind(b"\n") + 1
+        block, tail = block[:end], block[end:]
+        _parse_obj_block(block, pts, polys)
+    _parse_obj_block(tail, pts, polys)
+    return np.vstack(pts), np.vstack(polys)
 
-def get_ply_features(ply_file, smooths=[5, 20, 200]):
+def _parse_numbers(text, dtype):
+    """Parse whitespace-separated numbers, or return None if the text holds
+    anything else."""
+    with warnings.catch_warnings():
+        # numpy < 2 warns and stops at the first invalid number, numpy >= 2
+        # raises
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=dtype, sep=" ")
+        except (ValueError, DeprecationWarning):
+            return None
+
+def _parse_obj_block(block, pts, polys):
+    """Append the vertices and triangles of a block of OBJ lines to the lists."""
+    n_pts = sum(len(p) for p in pts)
+    # the lines are read up to their comments
+    vlines = re.findall(rb"^v ([^#\n]*)", block, re.M)
+    if vlines:
+        values = _parse_numbers(b"\n".join(vlines), np.double)
+        if values is not None and len(values) == 3 * len(vlines):
+            pts.append(values.reshape(-1, 3))
+        else:
+            # vertex colors, or a mix of line lengths
+            values = [line.split()[:3] for line in vlines]
+            pts.append(np.array(values, dtype=np.double))
+    flines = re.findall(rb"^f ([^#\n]*)", block, re.M)
+    if not flines:
+        return
+    # corners are "v", "v/vt", "v//vn" or "v/vt/vn": when all the faces are
+    # triangles with corners of the same kind, every line reads the same once
+    # its numbers are removed, and they hold 3 * width numbers
+    corner = flines[0].split()[0]
+    width = corner.count(b"/") + 1 - corner.count(b"//")
+    text = b"\n".join(flines)
+    digits = b"+-0123456789"
+    layout = flines[0].translate(None, digits)
+    uniform = len(layout.split()) == 3
+    if uniform:
+        uniform = text.translate(None, digits) == b"\n".join([layout] * len(flines))
+    if uniform:
+        values = text.replace(b"//", b" ").replace(b"/", b" ")
+        values = _parse_numbers(values, np.int64)
+        uniform = values is not None and len(values) == 3 * width * len(flines)
+    if uniform:
+        corners = values[::width]
+        sizes = np.full(len(flines), 3)
+    else:
+        corners = _parse_numbers(re.sub(rb"/\S*", b"", text), np.int64)
+        sizes = np.array([len(line.split()) for line in flines])
+        if corners is None or len(corners) != sizes.sum():
+            raise ValueError("Could not parse the faces of the OBJ file")
+    if (corners < 0).any():
+        # negative indices count back from the last vertex before the face
+        v_starts = [m.start() for m in re.finditer(rb"^v ", block, re.M)]
+        f_starts = [m.start() for m in re.finditer(rb"^f ", block, re.M)]
+        n_before = n_pts + np.searchsorted(v_starts, f_starts)
+        n_before = np.repeat(n_before, sizes)
+        corners = np.where(corners < 0, corners + n_before, corners - 1)
+    else:
+        corners = corners - 1
+    polys.append(_triangulate(corners, sizes))
+
+def _triangulate(corners, sizes):
+    """Split polygons, given by their concatenated `corners`, into triangle fans."""
+    if (sizes == 3).all():
+        return corners.reshape(-1, 3)
+    n_tris = sizes - 2
+    starts = np.repeat(np.cumsum(sizes) - sizes, n_tris)
+    fan = np.arange(len(starts)) - np.repeat(np.cumsum(n_tris) - n_tris, n_tris)
+    return corners[np.column_stack([starts, starts + fan + 1, starts + fan + 2])]
+
+def get_features(pts, polys, smooths=[5, 20, 200], use_cache=True):
+    """Vertex coordinates stacked with smoothed mean curvatures.
+
+    If `use_cache` is True, the curvatures are looked up in an on-disk cache
+    keyed by the content of `pts`, `polys`, the smoothing parameters and
+    `FEATURE_CACHE_VERSION`, and computed and stored on a miss.
+    """
+    if not use_cache:
+        return np.hstack([pts, _smoothed_curvatures(pts, polys, smooths)]), polys
+
+    key = cache.hash_arrays(
+        pts,
+        polys,
+        smooths=list(smooths),
+        iterations=3,
+        version=FEATURE_CACHE_VERSION,
+    )
+    path = os.path.join(cache.cache_dir("features"), key + ".npy")
+    if os.path.exists(path):
+        cache.touch(path)
+        sm_curvs = np.load(path, mmap_mode="r")
+    else:
+        sm_curvs = _smoothed_curvatures(pts, polys, smooths)
+        cache.save_atomic(path, sm_curvs)
+        cache.evict_lru(os.path.dirname(path), FEATURE_CACHE_MAX_BYTES)
+    return np.hstack([pts, sm_curvs]), polys
+
+def _smoothed_curvatures(pts, polys, smooths):
+    """Mean curvature smoothed by each factor in `smooths`, one per column."""
+    mass, stiffness, normals = mesh_operators(pts, polys)
+    curv = np.nan_to_num(mean_curvature(pts, mass, stiffness, normals))
+    return smooth(curv, mass, stiffness, smooths, iterations=3)
+
+def mesh_operators(pts, polys):
+    """Discrete Laplace-Beltrami operator and vertex normals of a mesh.
+
+    This follows `cortex.polyutils.Surface`, building every operator once with
+    vectorized numpy and scipy.sparse.
+
+    Returns
+    -------
+    mass : array, shape (n_vertices,)
+        Lumped mass matrix (a third of the area of the adjacent faces).
+    stiffness : sparse matrix, shape (n_vertices, n_vertices)
+        Cotangent stiffness matrix V - W, where W holds the cotangent weights
+        of the edges and V their row sums.
+    normals : array, shape (n_vertices, 3)
+        Unit vertex normals (average of the adjacent face normals).
+    """
+    from scipy import sparse
+
+    pts = np.asarray(pts, dtype=np.double)
+    polys = np.asarray(polys)
+    npt = len(pts)
+    ppts = pts[polys]
+    vert_ids = polys.ravel()
+
+    cross = np.cross(ppts[:, 1] - ppts[:, 0], ppts[:, 2] - ppts[:, 0])
+    double_areas = np.sqrt((cross ** 2).sum(1))
+    mass = np.bincount(vert_ids, np.repeat(double_areas / 2, 3), npt) / 3.0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        face_normals = np.nan_to_num(cross / double_areas[:, np.newaxis])
+        n_faces = np.bincount(vert_ids, minlength=npt)
+        normals = np.stack(
+            [np.bincount(vert_ids, np.repeat(fn, 3), npt) for fn in face_normals.T],
+            axis=1,
+        )
+        normals = np.nan_to_num(normals / n_faces[:, np.newaxis])
+        normals /= np.sqrt((normals ** 2).sum(1))[:, np.newaxis]
+
+        # cotangent of the angle at each corner, weighting the opposite edge
+        cots = []
+        for corner in range(3):
+            p0, p1, p2 = (ppts[:, (corner + k) % 3] for k in range(3))
+            cots.append(
+                ((p1 - p0) * (p2 - p0)).sum(1)
+                / np.sqrt((np.cross(p1 - p0, p2 - p0) ** 2).sum(1))
+            )
+    cots = np.concatenate(cots) / 2.0
+    cots[~np.isfinite(cots)] = 0
+    rows = np.concatenate([polys[:, 1], polys[:, 2], polys[:, 0]])
+    cols = np.concatenate([polys[:, 2], polys[:, 0], polys[:, 1]])
+    weights = sparse.coo_matrix(
+        (np.concatenate([cots, cots]),
+         (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        (npt, npt),
+    ).tocsr()
+    stiffness = sparse.diags(np.asarray(weights.sum(0)).ravel()) - weights
+    return mass, stiffness.tocsr(), normals
+
+def mean_curvature(pts, mass, stiffness, normals):
+    """Mean curvature at each vertex, from the operators of `mesh_operators`.
+
+    Positive values mean that the surface is folded outward.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        laplacian = stiffness.dot(np.asarray(pts, dtype=np.double))
+        return (laplacian / mass[:, np.newaxis] * normals).sum(1)
+
+def smooth(scalars, mass, stiffness, factors, iterations=1):
+    """Smooth `scalars` across the surface once for each of `factors`.
+
+    Each factor runs `iterations` implicit steps of the mean curvature flow
+    smoothing of `cortex.polyutils.Surface.smooth`, i.e. solves
+    (M + factor * S) x = M x with M the lumped mass matrix and S the
+    stiffness matrix. Each system matrix is symmetric, so it is factorized
+    once in SuperLU's symmetric mode with a minimum-degree ordering of
+    S + S', which is much faster than the default unsymmetric factorization.
+    Vertices without any area are left at zero.
+
+    Returns
+    -------
+    smscalars : array, shape (n_vertices, len(factors))
+        Smoothed scalars, one column per factor.
+    """
+    from scipy import sparse
+    from scipy.sparse import linalg as sparse_linalg
+
+    good = np.nonzero(mass != 0)[0]
+    good_mass = mass[good]
+    good_stiffness = stiffness[good][:, good]
+    smscalars = np.zeros((len(scalars), len(factors)))
+    for col, factor in enumerate(factors):
+        if factor == 0.0:
+            smscalars[:, col] = scalars
+            continue
+        lfac = (sparse.diags(good_mass) + factor * good_stiffness).tocsc()
+        solver = sparse_linalg.splu(
+            lfac,
+            permc_spec="MMD_AT_PLUS_A",
+            diag_pivot_thresh=0,
+            options=dict(SymmetricMode=True),
+        )
+        to_smooth = np.asarray(scalars, dtype=np.double)[good]
+        for _ in range(iterations):
+            to_smooth = solver.solve(good_mass * to_smooth)
+        smscalars[good, col] = to_smooth
+    return smscalars
+
+def get_ply_features(ply_file, smooths=[5, 20, 200], use_cache=True):
     pts, polys = load_ply(ply_file)
-    return get_features(pts, polys, smooths)
+    return get_features(pts, polys, smooths, use_cache)
+
+def get_stl_features(stl_file, smooths=[5, 20, 200], use_cache=True):
+    pts, polys = read_stl(stl_file)
+    return get_features(pts, polys, smooths, use_cache)
+
+def save_stl_features(stl_file, feature_file, smooths=[5, 20, 200], use_cache=True):
+    """Save the features of an STL file as the `features` array of a .npz file.
+
+    The file is written under a temporary name and then renamed, so that an
+    interrupted run never leaves a partial feature file.
+    """
+    feats, polys = get_stl_features(stl_file, smooths, use_cache)
+    with cache.atomic_path(feature_file) as tmp, open(tmp, "wb") as fp:
+        np.savez(fp, features=feats)
+
+def voxel_subsample(pts, n_points):
+    """Spatially uniform subsample of about `n_points` points.
 
-def get_stl_features(stl_file, smooths=[5, 20, 200]):
-    pts, polys = cortex.formats.read_stl(stl_file)
-    return get_features(pts, polys, smooths)
+    Points are binned on a regular voxel grid and one point is kept per
+    occupied voxel. Since scans are surfaces, the number of occupied voxels
+    grows with the inverse square of the voxel size, which is used to adjust
+    the grid until the subsample is within 10% of `n_points`. If `n_points`
+    is None or not smaller than the number of points, all points are used.
 
-def save_stl_features(stl_file, feature_file, smooths=[5, 20, 200]):
-    feats, polys = get_stl_features(stl_file, smooths)
-    np.savez(feature_file, features=feats)
\ No newline at end of file
+    Returns the indices of the kept points and the number of points in each
+    of their voxels, which can be used as weights so that averages over the
+    subsample approximate averages over all points.
+    """
+    if n_points is None or n_points >= len(pts):
+        return np.arange(len(pts)), np.ones(len(pts), dtype=np.int64)
+    offset = pts - pts.min(0)
+    size = offset.max() / np.sqrt(n_points)
+    for _ in range(10):
+        keys = np.floor(offset / size).astype(np.int64)
+        dims = keys.max(0) + 1
+        flat = (keys[:, 0] * dims[1] + keys[:, 1]) * dims[2] + keys[:, 2]
+        _, idx, counts = np.unique(flat, return_index=True, return_counts=True)
+        if abs(len(idx) - n_points) <= 0.1 * n_points:
+            break
+        size *= np.sqrt(len(idx) / n_points)
+    order = np.argsort(idx)
+    return idx[order], counts[order]
@@ -0,0 +1,326 @@
+"""Generate headcases for many head models, pipelining the stages across scans.
+
+The input is either a directory of head models generated by the Structure
+Sensor (.zip or .obj), or a CSV manifest with one head model per row. The
+manifest has an `infile` column, and optionally `outfile`, `casetype`,
+`nparts`, `expand_head_model` and `customizations` columns overriding the
+command line options for that row, and a `subject` column whose alignments
+warm-start the alignment of the next scans of that subject (see
+`make_headcase.align_scan`). Relative paths are relative to the manifest.
+
+Each stage (cleaning, alignment, carving) has its own pool of worker
+processes, so one scan can be cleaned while another one is aligned and a third
+one is carved. Scans that fail the pre-flight check of their alignment (see
+`make_headcase.preflight_check`) are not carved. A summary of the outcome and
+the time taken by each stage is printed at the end.
+
+Example
+-------
+python batch_headcase.py scans.csv headcases/ --align-workers 2
+"""
+import argparse
+import csv
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import util
+from tempfile import mkdtemp
+
+from make_headcase import (
+    DEFAULT_CUSTOMIZATIONS,
+    BlenderWorker,
+    align_scan,
+    gen_case,
+    model_clean,
+    preflight_check,
+)
+
+STAGES = ["clean", "align", "carve"]
+
+# Blender process kept by each worker of the carving pool.
+_blender_worker = None
+
+
+def read_jobs(source, outdir, casetype, nparts, expand_head_model, customizations):
+    """List the jobs of a directory of head models or of a CSV manifest."""
+    defaults = dict(
+        casetype=casetype,
+        nparts=nparts,
+        expand_head_model=expand_head_model,
+        customizations=os.path.abspath(customizations),
+        subject=None,
+    )
+    if os.path.isdir(source):
+        rows = [
+            dict(infile=fn)
+            for fn in sorted(os.listdir(source))
+            if fn.lower().endswith((".zip", ".obj"))
+        ]
+        root = source
+    else:
+        with open(source, newline="") as fp:
+            rows = [
+                {key: value for key, value in row.items() if value}
+                for row in csv.DictReader(fp)
+            ]
+        root = os.path.dirname(os.path.abspath(source))
+
+    jobs = []
+    for row in rows:
+        job = dict(defaults, **row)
+        job["infile"] = os.path.join(root, job["infile"])
+        name = os.path.splitext(os.path.basename(job["infile"]))[0]
+        job["name"] = name
+        if "outfile" in job:
+            job["outfile"] = os.path.join(root, job["outfile"])
+        else:
+            job["outfile"] = os.path.join(outdir, f"{name}_headcase.zip")
+        if "customizations" in row:
+            job["customizations"] = os.path.join(root, row["customizations"])
+        job["nparts"] = int(job["nparts"])
+        job["expand_head_model"] = float(job["expand_head_model"])
+        jobs.append(job)
+    names = [job["name"] for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Several head models are named {', '.join(duplicates)}")
+    return jobs
+
+
+def _init_carve_worker(backend):
+    """Start a Blender process for this worker of the carving pool."""
+    global _blender_worker
+    if backend == "blender":
+        _blender_worker = BlenderWorker()
+        util.Finalize(_blender_worker, _blender_worker.close, exitpriority=10)
+
+
+def run_stage(stage, job, workdir, carve_backend):
+    """Run one stage of a job, and return the time it took."""
+    start = time.perf_counter()
+    cleaned = os.path.join(workdir, "01cleaned.ply")
+    aligned = os.path.join(workdir, "02aligned.stl")
+    if stage == "clean":
+        model_clean(os.path.abspath(job["infile"]), cleaned)
+    elif stage == "align":
+        align_scan(cleaned, aligned, subject=job["subject"])
+        preflight_check(aligned, job["casetype"])
+    else:
+        gen_case(
+            aligned,
+            os.path.abspath(job["outfile"]),
+            workdir,
+            casetype=job["casetype"],
+            nparts=job["nparts"],
+            customizations=job["customizations"],
+            expand_head_model=job["expand_head_model"],
+            backend=carve_backend,
+            blender_worker=_blender_worker,
+            n_jobs=1,
+        )
+    return time.perf_counter() - start
+
+
+def run_batch(
+    jobs,
+    workdir=None,
+    clean_workers=1,
+    align_workers=1,
+    carve_workers=1,
+    max_in_flight=None,
+    carve_backend="blender",
+):
+    """
+    Run the jobs, with one pool of worker processes per stage.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Jobs, as returned by `read_jobs`.
+    workdir : str, optional
+        Directory where the intermediate files of each job are kept, in a
+        subdirectory named after the job. By default, they are stored in
+        temporary directories deleted at the end of each job.
+    clean_workers, align_workers, carve_workers : int, optional
+        Number of worker processes of each stage. Default is 1.
+    max_in_flight : int, optional
+        Maximum number of jobs started and not yet finished, which bounds the
+        disk space used by intermediate files. Default is the total number of
+        workers.
+    carve_backend : str, optional
+        Library used to carve the headcases, see `gen_case`. With Blender, each
+        carving worker keeps a Blender process running between jobs.
+
+    Returns
+    -------
+    list of dict
+        Outcome of each job: `name`, `status` ("done" or "failed"), the time
+        taken by each completed stage, and the `stage` and `error` of failures.
+    """
+    if max_in_flight is None:
+        max_in_flight = clean_workers + align_workers + carve_workers
+    pools = dict(
+        clean=ProcessPoolExecutor(clean_workers),
+        align=ProcessPoolExecutor(align_workers),
+        carve=ProcessPoolExecutor(
+            carve_workers, initializer=_init_carve_worker, initargs=(carve_backend,)
+        ),
+    )
+    results = [dict(name=job["name"], status="pending") for job in jobs]
+    workdirs = {}
+    pending = list(range(len(jobs)))[::-1]
+    in_flight = set()
+    running = {}
+
+    def submit(index, stage):
+        future = pools[stage].submit(
+            run_stage, stage, jobs[index], workdirs[index], carve_backend
+        )
+        running[future] = (index, stage)
+
+    def finish(index, status):
+        in_flight.remove(index)
+        results[index]["status"] = status
+        print(f"{jobs[index]['name']}: {status}")
+        if workdir is None:
+            shutil.rmtree(workdirs[index], ignore_errors=True)
+
+    try:
+        while pending or running:
+            while pending and len(in_flight) < max_in_flight:
+                index = pending.pop()
+                in_flight.add(index)
+                if workdir is None:
+                    workdirs[index] = mkdtemp()
+                else:
+                    workdirs[index] = os.path.join(
+                        os.path.abspath(workdir), jobs[index]["name"]
+                    )
+                    os.makedirs(workdirs[index], exist_ok=True)
+                submit(index, "clean")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, stage = running.pop(future)
+                try:
+                    results[index][stage] = future.result()
+                except Exception as exc:
+                    results[index]["stage"] = stage
+                    results[index]["error"] = "".join(
+                        traceback.format_exception_only(type(exc), exc)
+                    ).strip()
+                    finish(index, "failed")
+                    continue
+                if stage == STAGES[-1]:
+                    finish(index, "done")
+                else:
+                    submit(index, STAGES[STAGES.index(stage) + 1])
+    finally:
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=True)
+    return results
+
+
+def print_summary(results):
+    """Print the outcome and stage timings of each job."""
+    name_width = max([len("scan")] + [len(result["name"]) for result in results])
+    header = "  ".join(f"{stage:>7}" for stage in STAGES)
+    print(f"{'scan':<{name_width}}  {'status':<6}  {header}")
+    for result in results:
+        times = "  ".join(
+            f"{result[stage]:6.1f}s" if stage in result else f"{'-':>7}"
+            for stage in STAGES
+        )
+        print(f"{result['name']:<{name_width}}  {result['status']:<6}  {times}")
+        if "error" in result:
+            print(f"{'':<{name_width}}  {result['stage']}: {result['error']}")
+    n_done = sum(result["status"] == "done" for result in results)
+    print(f"{n_done} of {len(results)} headcases generated")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "source", type=str, help="directory of head models, or CSV manifest"
+    )
+    parser.add_argument(
+        "outdir", type=str, help="directory of the output headcases (*.zip)"
+    )
+    parser.add_argument(
+        "--headcoil",
+        "-c",
+        type=str,
+        default="s32",
+        choices=["s32", "s64", "n32", "meg_ctf275"],
+        help="Default type of headcoil. Default: s32",
+    )
+    parser.add_argument(
+        "--nparts",
+        "-p",
+        type=int,
+        default=4,
+        choices=[2, 4],
+        help="Default number of parts. Default: 4",
+    )
+    parser.add_argument(
+        "--expand-head-model",
+        type=float,
+        default=0.1,
+        help="Default expansion of the head models (in mm). Default: 0.1",
+    )
+    parser.add_argument(
+        "--customizations-file",
+        type=str,
+        default=DEFAULT_CUSTOMIZATIONS,
+        help=f"Default customizations file. Default: {DEFAULT_CUSTOMIZATIONS}",
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        default=None,
+        help="Keep the intermediate models of each scan in a subdirectory of this "
+        "directory. By default, they are deleted.",
+    )
+    parser.add_argument("--clean-workers", type=int, default=1)
+    parser.add_argument("--align-workers", type=int, default=1)
+    parser.add_argument("--carve-workers", type=int, default=1)
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=None,
+        help="Maximum number of scans being processed at the same time. "
+        "Default: the total number of workers",
+    )
+    parser.add_argument(
+        "--carve-backend",
+        type=str,
+        default="blender",
+        choices=["blender", "manifold"],
+        help="Library used to carve the headcases. Default: blender",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    jobs = read_jobs(
+        args.source,
+        args.outdir,
+        casetype=args.headcoil,
+        nparts=args.nparts,
+        expand_head_model=args.expand_head_model,
+        customizations=args.customizations_file,
+    )
+    print(f"Generating {len(jobs)} headcases")
+    results = run_batch(
+        jobs,
+        workdir=args.workdir,
+        clean_workers=args.clean_workers,
+        align_workers=args.align_workers,
+        carve_workers=args.carve_workers,
+        max_in_flight=args.max_in_flight,
+        carve_backend=args.carve_backend,
+    )
+    print_summary(results)
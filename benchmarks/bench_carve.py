@@ -0,0 +1,93 @@
+"""Benchmark the carving backends of `make_headcase.gen_case`.
+
+Carves the same aligned head model with each backend, and reports the time
+taken and, for every part, the number of triangles and the enclosed volume,
+so that the outputs of the backends can be compared. The Blender backend is
+skipped if Blender is not on the PATH.
+
+Example
+-------
+python benchmarks/bench_carve.py /path/to/workdir/02aligned.stl --nparts 4
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from tempfile import mkdtemp
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from autocase3d.util import read_stl  # noqa: E402
+from make_headcase import DEFAULT_CUSTOMIZATIONS, gen_case  # noqa: E402
+
+
+def mesh_volume(pts, polys):
+    """Volume enclosed by a closed, consistently oriented triangle mesh."""
+    tris = pts[polys]
+    return np.einsum("ij,ij->i", tris[:, 0], np.cross(tris[:, 1], tris[:, 2])).sum() / 6
+
+
+def run_backend(backend, scanfile, casetype, nparts, customizations):
+    workdir = mkdtemp()
+    try:
+        start = time.perf_counter()
+        gen_case(
+            scanfile,
+            os.path.join(workdir, "case.zip"),
+            workdir=workdir,
+            casetype=casetype,
+            nparts=nparts,
+            customizations=customizations,
+            backend=backend,
+        )
+        elapsed = time.perf_counter() - start
+        parts = {}
+        for fn in sorted(os.listdir(workdir)):
+            if fn.endswith(".stl"):
+                pts, polys = read_stl(os.path.join(workdir, fn))
+                parts[fn] = dict(
+                    n_faces=len(polys), volume=float(mesh_volume(pts, polys))
+                )
+    finally:
+        shutil.rmtree(workdir)
+    return dict(backend=backend, seconds=elapsed, parts=parts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scanfile", type=str, help="cleaned and aligned head (.stl)")
+    parser.add_argument("--headcoil", "-c", type=str, default="s32")
+    parser.add_argument("--nparts", "-p", type=int, default=4, choices=[2, 4])
+    parser.add_argument(
+        "--customizations-file", type=str, default=DEFAULT_CUSTOMIZATIONS
+    )
+    parser.add_argument("--output", type=str, default=None, help="JSON results file")
+    args = parser.parse_args()
+
+    backends = ["manifold"]
+    if shutil.which("blender") is not None:
+        backends.append("blender")
+    else:
+        print("Blender not found, skipping the blender backend")
+
+    results = [
+        run_backend(
+            backend,
+            os.path.abspath(args.scanfile),
+            args.headcoil,
+            args.nparts,
+            args.customizations_file,
+        )
+        for backend in backends
+    ]
+    for result in results:
+        print(f"{result['backend']}: {result['seconds']:.2f} s")
+        for fn, part in result["parts"].items():
+            print(f"  {fn}: {part['n_faces']} faces, {part['volume'] / 1000:.1f} cm^3")
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,329 @@
+"""Benchmark every stage of the pipeline on synthetic head models.
+
+Generates deterministic head-like meshes (a noisy ellipsoid with a nose and
+ears, optionally with holes and small disconnected fragments, as in real
+scans) at several resolutions, and times each stage on them: cleaning
+(`model_clean`), curvature features (`get_features`), the GMM kernel alone
+(`prob_and_grad`), alignment (`align_scan`) and carving (`gen_case`). Each
+measurement runs in a fresh process, which reports its wall time, CPU time and
+peak resident memory. Carving uses the manifold backend, so Blender is not
+needed, and is skipped if manifold3d is not installed.
+
+The results are written as JSON, to be compared across commits.
+
+Example
+-------
+python benchmarks/bench_pipeline.py --vertices 20000 100000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess as sp
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import mkdtemp
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+STAGES = ["clean", "features", "gmm", "align", "carve"]
+# Number of evaluations of the GMM objective and gradient timed by the gmm stage.
+GMM_EVALUATIONS = 10
+
+# Semi-axes and center of the synthetic heads, in mm.
+HEAD_AXES = np.array([75.0, 110.0, 95.0])
+HEAD_CENTER = np.array([0.0, -16.0, -2.0])
+
+
+def synthetic_head(n_vertices, seed=0, noise=0.2, n_holes=0, n_fragments=0):
+    """
+    Triangle mesh of a synthetic head, in mm.
+
+    Parameters
+    ----------
+    n_vertices : int
+        Number of vertices of the head surface.
+    seed : int, optional
+        Seed of the noise, holes and fragments. The same arguments always give
+        the same mesh.
+    noise : float, optional
+        Standard deviation of the radial noise, in mm. Default is 0.2.
+    n_holes : int, optional
+        Number of holes cut in the surface. Default is 0.
+    n_fragments : int, optional
+        Number of small disconnected fragments floating around the head.
+        Default is 0.
+
+    Returns
+    -------
+    pts : array, shape (n_vertices, 3)
+        Vertices of the mesh.
+    polys : array, shape (n_faces, 3)
+        Faces of the mesh, oriented outwards.
+    """
+    from scipy.spatial import ConvexHull
+
+    rng = np.random.default_rng(seed)
+    # Fibonacci sphere, triangulated by its convex hull
+    index = np.arange(n_vertices) + 0.5
+    phi = np.arccos(1 - 2 * index / n_vertices)
+    theta = np.pi * (1 + 5**0.5) * index
+    unit = np.column_stack(
+        [np.cos(theta) * np.sin(phi), np.cos(phi), np.sin(theta) * np.sin(phi)]
+    )
+    polys = ConvexHull(unit).simplices
+    normals = np.cross(
+        unit[polys[:, 1]] - unit[polys[:, 0]], unit[polys[:, 2]] - unit[polys[:, 0]]
+    )
+    inwards = np.einsum("ij,ij->i", normals, unit[polys].mean(1)) < 0
+    polys[inwards] = polys[inwards, ::-1]
+
+    x, y, z = unit.T
+    nose = 0.25 * np.exp(-((x / 0.12) ** 2) - ((y + 0.1) / 0.2) ** 2) * (z > 0)
+    ears = sum(
+        0.08
+        * np.exp(-(((x - side) / 0.1) ** 2) - ((y + 0.05) / 0.15) ** 2 - (z / 0.1) ** 2)
+        for side in (1, -1)
+    )
+    radius = 1 + nose + ears
+    pts = unit * radius[:, np.newaxis] * HEAD_AXES
+    pts += unit * rng.normal(scale=noise, size=(n_vertices, 1)) + HEAD_CENTER
+
+    for _ in range(n_holes):
+        center = unit[rng.integers(n_vertices)]
+        keep = np.dot(unit[polys].mean(1), center) < np.cos(0.05)
+        polys = polys[keep]
+    for _ in range(n_fragments):
+        # a small tetrahedron a few cm away from the head
+        center = unit[rng.integers(n_vertices)] * HEAD_AXES * 1.3 + HEAD_CENTER
+        corners = center + rng.normal(scale=3, size=(4, 3))
+        faces = len(pts) + ConvexHull(corners).simplices
+        pts = np.vstack([pts, corners])
+        polys = np.vstack([polys, faces])
+    return pts, polys.astype(np.int64)
+
+
+def write_scan(path, pts, polys):
+    """Write a mesh in mm as a Structure Sensor archive (Model.obj, in m)."""
+    lines = [f"v {x:.6f} {y:.6f} {z:.6f}" for x, y, z in pts / 1000]
+    lines += [f"f {a} {b} {c}" for a, b, c in polys + 1]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as pkg:
+        pkg.writestr("Model.obj", "\n".join(lines) + "\n")
+
+
+def _peak_rss():
+    """Peak resident memory of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _load_gmm():
+    from autocase3d.fmin_autograd import _load_gmm_model
+
+    return _load_gmm_model()
+
+
+def _run_clean(scanfile):
+    from make_headcase import model_clean
+
+    return model_clean(scanfile, None)
+
+
+def _run_features(pts, polys):
+    from autocase3d.util import get_features
+
+    return get_features(pts, polys, use_cache=False)[0]
+
+
+def _run_gmm(features):
+    from autocase3d import squash_features
+    from autocase3d.fmin_autograd import prob_and_grad
+
+    gmm, means, stds = _load_gmm()
+    feats = squash_features(features, means, stds)
+    for _ in range(GMM_EVALUATIONS):
+        prob_and_grad(np.zeros(6), feats, gmm)
+
+
+def _run_align(pts, polys):
+    from make_headcase import align_scan
+
+    return align_scan((pts, polys), None)
+
+
+def _run_carve(pts, polys, casetype):
+    from make_headcase import gen_case
+
+    workdir = mkdtemp()
+    try:
+        gen_case(
+            (pts, polys),
+            os.path.join(workdir, "case.zip"),
+            workdir,
+            casetype=casetype,
+            backend="manifold",
+            n_jobs=1,
+        )
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _measure(func, *args):
+    """Run `func` and return its result, wall time, CPU time and peak memory."""
+    # imports are not part of the measurement
+    import make_headcase  # noqa: F401
+    from autocase3d import fmin_autograd, util  # noqa: F401
+
+    start_rss = _peak_rss()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    result = func(*args)
+    stats = dict(
+        seconds=time.perf_counter() - start,
+        cpu_seconds=time.process_time() - start_cpu,
+        peak_rss_mb=_peak_rss(),
+        rss_increase_mb=_peak_rss() - start_rss,
+    )
+    return result, stats
+
+
+def measure(func, *args, repeats=1):
+    """Best of `repeats` runs of `func(*args)`, each in a fresh process."""
+    runs = []
+    for _ in range(repeats):
+        with ProcessPoolExecutor(1) as pool:
+            result, stats = pool.submit(_measure, func, *args).result()
+        runs.append(stats)
+    best = min(runs, key=lambda stats: stats["seconds"])
+    median = float(np.median([stats["seconds"] for stats in runs]))
+    return result, dict(best, median_seconds=median)
+
+
+def bench_head(
+    n_vertices, stages, seed=0, n_holes=0, n_fragments=0, repeats=1, casetype="s32"
+):
+    """Benchmark the stages on one synthetic head, and return the results."""
+    pts, polys = synthetic_head(
+        n_vertices, seed=seed, n_holes=n_holes, n_fragments=n_fragments
+    )
+    results = dict(n_vertices=len(pts), n_faces=len(polys), stages={})
+    tempdir = mkdtemp()
+    try:
+        scanfile = os.path.join(tempdir, "Model.zip")
+        write_scan(scanfile, pts, polys)
+        if "clean" in stages:
+            (pts, polys), stats = measure(_run_clean, scanfile, repeats=repeats)
+            results["stages"]["clean"] = dict(
+                stats, n_vertices=len(pts), n_faces=len(polys)
+            )
+        else:
+            # the other stages take a cleaned scan, which is closed
+            pts, polys = synthetic_head(n_vertices, seed=seed)
+        if "features" in stages or "gmm" in stages:
+            features, stats = measure(_run_features, pts, polys, repeats=repeats)
+            if "features" in stages:
+                results["stages"]["features"] = stats
+            if "gmm" in stages:
+                _, stats = measure(_run_gmm, features, repeats=repeats)
+                results["stages"]["gmm"] = dict(
+                    stats, n_points=len(features), evaluations=GMM_EVALUATIONS
+                )
+        if "align" in stages:
+            (pts, polys), stats = measure(_run_align, pts, polys, repeats=repeats)
+            results["stages"]["align"] = stats
+        if "carve" in stages:
+            try:
+                import manifold3d  # noqa: F401
+            except ImportError:
+                print("manifold3d not found, skipping the carve stage")
+            else:
+                _, stats = measure(_run_carve, pts, polys, casetype, repeats=repeats)
+                results["stages"]["carve"] = stats
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+
+def git_commit():
+    """Current commit of the repository, if it is a git checkout."""
+    try:
+        commit = sp.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return None
+    return commit or None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--vertices",
+        type=int,
+        nargs="+",
+        default=[20000, 100000],
+        help="Resolutions of the synthetic heads. Default: 20000 100000",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        nargs="+",
+        default=STAGES,
+        choices=STAGES,
+        help="Stages to benchmark. Default: all",
+    )
+    parser.add_argument("--holes", type=int, default=3, help="Default: 3")
+    parser.add_argument("--fragments", type=int, default=5, help="Default: 5")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--headcoil", "-c", type=str, default="s32")
+    parser.add_argument("--output", type=str, default=None, help="JSON results file")
+    args = parser.parse_args()
+
+    # keep the feature and template caches of the user out of the measurements
+    cache_dir = mkdtemp()
+    os.environ["HEADCASE_CACHE_DIR"] = cache_dir
+    try:
+        heads = []
+        for n_vertices in args.vertices:
+            print(f"Head with {n_vertices} vertices")
+            result = bench_head(
+                n_vertices,
+                args.stages,
+                seed=args.seed,
+                n_holes=args.holes,
+                n_fragments=args.fragments,
+                repeats=args.repeats,
+                casetype=args.headcoil,
+            )
+            for stage, stats in result["stages"].items():
+                print(
+                    f"  {stage:<8}  {stats['seconds']:7.2f} s  "
+                    f"cpu {stats['cpu_seconds']:7.2f} s  "
+                    f"peak {stats['peak_rss_mb']:7.0f} MB"
+                )
+            heads.append(result)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    results = dict(
+        commit=git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        options=vars(args),
+        heads=heads,
+    )
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
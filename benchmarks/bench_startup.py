@@ -0,0 +1,69 @@
+"""Benchmark the startup time of the pipeline.
+
+Times, in fresh Python interpreters, the import of the pipeline modules and
+the command-line entry points (`--help`), and reports the best and median time
+over several repeats. Heavy dependencies (pymeshlab, sklearn, scipy, cortex)
+should only be imported by the stages that use them, so importing
+`make_headcase` or running `--help` should not pay for them.
+
+Example
+-------
+python benchmarks/bench_startup.py --repeats 5
+"""
+import argparse
+import json
+import os
+import subprocess as sp
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = [
+    "make_headcase",
+    "batch_headcase",
+    "carve_manifold",
+    "autocase3d",
+    "autocase3d.util",
+    "autocase3d.fmin_autograd",
+]
+SCRIPTS = ["make_headcase.py", "batch_headcase.py"]
+
+
+def time_command(cmd, repeats):
+    """Wall time of `cmd` run `repeats` times from the root of the repository."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        sp.run(cmd, cwd=ROOT, check=True, stdout=sp.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return dict(best=min(times), median=float(np.median(times)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None, help="JSON results file")
+    args = parser.parse_args()
+
+    results = dict(python=time_command([sys.executable, "-c", "pass"], args.repeats))
+    for module in MODULES:
+        results[f"import {module}"] = time_command(
+            [sys.executable, "-c", f"import {module}"], args.repeats
+        )
+    for script in SCRIPTS:
+        results[f"{script} --help"] = time_command(
+            [sys.executable, script, "--help"], args.repeats
+        )
+
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        print(
+            f"{name:<{width}}  best {result['best']:.3f} s  "
+            f"median {result['median']:.3f} s"
+        )
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
@@ -1,66 +1,31 @@
-blender_carve_model_template = """import sys
+# Functions that carve a headcase inside Blender. This code must not contain
+# curly braces, since it is combined with the templates below and formatted
+# with `str.format`.
+blender_carve_functions = """import sys
 import bpy
 import bpy.ops
 from bpy import context as C
 from bpy import data as D
 import os.path
 
-bpy.context.scene.objects.active = bpy.data.objects['Cube']
-bpy.ops.object.delete()
 
-def readstl(path, name):
+def readstl(path, name, cache=None):
+    # files changed since they were cached are imported again
+    if cache is not None:
+        key = (path, os.path.getmtime(path), os.path.getsize(path))
+        if key in cache:
+            obj = bpy.data.objects.new(name, cache[key].copy())
+            bpy.context.scene.objects.link(obj)
+            return
     tempname = bpy.path.display_name(os.path.basename(path))
     bpy.ops.import_mesh.stl(filepath=path)
     bpy.data.objects[tempname].name = name
-
-readstl('{preview}', 'preview')
-readstl('{scan}', 'scan')
-
-
-bpy.ops.object.select_all(action='DESELECT')
-bpy.context.scene.objects.active = bpy.data.objects['scan']
-bpy.ops.object.mode_set(mode = 'EDIT')
-bpy.ops.mesh.select_all(action='SELECT')
-for _ in range(3):
-    bpy.ops.mesh.remove_doubles(threshold=0.75)
-    bpy.ops.mesh.select_all(action='DESELECT')
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.edge_collapse()
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.edge_collapse()
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.edge_collapse()
-bpy.ops.object.mode_set(mode = 'OBJECT')
-
-# shrinking
-bpy.ops.object.select_all(action='DESELECT')
-bpy.context.scene.objects.active = bpy.data.objects['scan']
-bpy.ops.object.mode_set(mode = 'OBJECT')
-bpy.ops.object.modifier_add(type='DISPLACE')
-bpy.data.objects['scan'].modifiers['Displace'].name = 'shrinking'
-bpy.data.objects['scan'].modifiers['shrinking'].direction = 'NORMAL'
-bpy.data.objects['scan'].modifiers['shrinking'].mid_level = 0
-bpy.data.objects['scan'].modifiers['shrinking'].strength = {shrinking_factor}
-
-try:
-    readstl('{customizations}', 'customizations')
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.scene.objects.active = bpy.data.objects['scan']
-    bpy.ops.object.modifier_add(type='BOOLEAN')
-    bpy.data.objects['scan'].modifiers['Boolean'].name = 'Customizations'
-    bpy.data.objects['scan'].modifiers['Customizations'].operation = 'UNION'
-    bpy.data.objects['scan'].modifiers['Customizations'].solver = 'CARVE'
-    bpy.data.objects['scan'].modifiers['Customizations'].object = bpy.data.objects['customizations']
-except:
-    pass
-
-bpy.ops.object.select_all(action='DESELECT')
-bpy.context.scene.objects.active = bpy.data.objects['preview']
-bpy.ops.object.modifier_add(type='BOOLEAN')
-bpy.data.objects['preview'].modifiers['Boolean'].name = 'scan'
-bpy.data.objects['preview'].modifiers['scan'].operation = 'DIFFERENCE'
-bpy.data.objects['preview'].modifiers['scan'].solver = 'CARVE'
-bpy.data.objects['preview'].modifiers['scan'].object = bpy.data.objects['scan']
+    if cache is not None:
+        for old in [old for old in cache if old[0] == path]:
+            cache.pop(old).use_fake_user = False
+        mesh = bpy.data.objects[name].data.copy()
+        mesh.use_fake_user = True
+        cache[key] = mesh
 
 
 def intersect_cube(name, loc, radius):
@@ -73,33 +38,193 @@ def intersect_cube(name, loc, radius):
     bpy.data.objects[name].modifiers['case'].operation = 'INTERSECT'
     bpy.data.objects[name].modifiers['case'].object = bpy.data.objects['preview']
     bpy.ops.object.modifier_apply(apply_as='DATA', modifier='case')
-    
-    
-nparts = {nparts}
-radius = 99.9 if nparts == 4 else 199.9
-
-if nparts == 4:
-    intersect_cube('front_bottom', (0, -20, 100), radius)
-    bpy.ops.transform.rotate(value=3.14159265/2, axis=(-1, 0, 0))
-    bpy.ops.export_mesh.stl(filepath='{tempdir}/front_bottom.stl', use_selection=True)
-    
-    intersect_cube('back_bottom', (0, -20, -100), radius)
-    bpy.ops.transform.rotate(value=3.14159265/2, axis=(-1, 0, 0))
-    bpy.ops.transform.translate(value=(0, 0, 200))
-    bpy.ops.export_mesh.stl(filepath='{tempdir}/back_bottom.stl', use_selection=True)
-    
-    intersect_cube('front_top', (0, 180, 100), radius)
-    bpy.ops.export_mesh.stl(filepath='{tempdir}/front_top.stl', use_selection=True)
-    
-    intersect_cube('back_top', (0, 180, -100), radius)
-    bpy.ops.transform.rotate(value=3.14159265, axis=(-1, 0, 0))
-    bpy.ops.export_mesh.stl(filepath='{tempdir}/back_top.stl', use_selection=True)
-else:
-    intersect_cube('front', (0, 0, 200), radius)
-    bpy.ops.transform.rotate(value=3.14159265/2, axis=(-1, 0, 0))
-    bpy.ops.export_mesh.stl(filepath='{tempdir}/front.stl', use_selection=True)
-    
-    intersect_cube('back', (0, 0, -200), radius)
-    bpy.ops.transform.rotate(value=3.14159265/2, axis=(-1, 0, 0))
-    bpy.ops.export_mesh.stl(filepath='{tempdir}/back.stl', use_selection=True)
-"""
\ No newline at end of file
+
+
+def part_layout(nparts):
+    # name, center of the cutting box, rotations (angle, axis) and translation
+    # applied to the part before export
+    if nparts == 4:
+        return [
+            ('front_bottom', (0, -20, 100), [(3.14159265/2, (-1, 0, 0))], (0, 0, 0)),
+            ('back_bottom', (0, -20, -100), [(3.14159265/2, (-1, 0, 0))], (0, 0, 200)),
+            ('front_top', (0, 180, 100), [], (0, 0, 0)),
+            ('back_top', (0, 180, -100), [(3.14159265, (-1, 0, 0))], (0, 0, 0)),
+        ]
+    return [
+        ('front', (0, 0, 200), [(3.14159265/2, (-1, 0, 0))], (0, 0, 0)),
+        ('back', (0, 0, -200), [(3.14159265/2, (-1, 0, 0))], (0, 0, 0)),
+    ]
+
+
+def carve_case(preview, scan, customizations, shrinking_factor, cache=None):
+    readstl(preview, 'preview', cache)
+    readstl(scan, 'scan')
+
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.context.scene.objects.active = bpy.data.objects['scan']
+    bpy.ops.object.mode_set(mode = 'EDIT')
+    bpy.ops.mesh.select_all(action='SELECT')
+    for _ in range(3):
+        bpy.ops.mesh.remove_doubles(threshold=0.75)
+        bpy.ops.mesh.select_all(action='DESELECT')
+        bpy.ops.mesh.select_non_manifold()
+        bpy.ops.mesh.edge_collapse()
+        bpy.ops.mesh.select_non_manifold()
+        bpy.ops.mesh.edge_collapse()
+        bpy.ops.mesh.select_non_manifold()
+        bpy.ops.mesh.edge_collapse()
+    bpy.ops.object.mode_set(mode = 'OBJECT')
+
+    # shrinking
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.context.scene.objects.active = bpy.data.objects['scan']
+    bpy.ops.object.mode_set(mode = 'OBJECT')
+    bpy.ops.object.modifier_add(type='DISPLACE')
+    bpy.data.objects['scan'].modifiers['Displace'].name = 'shrinking'
+    bpy.data.objects['scan'].modifiers['shrinking'].direction = 'NORMAL'
+    bpy.data.objects['scan'].modifiers['shrinking'].mid_level = 0
+    bpy.data.objects['scan'].modifiers['shrinking'].strength = shrinking_factor
+
+    if customizations:
+        try:
+            readstl(customizations, 'customizations', cache)
+            bpy.ops.object.select_all(action='DESELECT')
+            bpy.context.scene.objects.active = bpy.data.objects['scan']
+            bpy.ops.object.modifier_add(type='BOOLEAN')
+            bpy.data.objects['scan'].modifiers['Boolean'].name = 'Customizations'
+            bpy.data.objects['scan'].modifiers['Customizations'].operation = 'UNION'
+            bpy.data.objects['scan'].modifiers['Customizations'].solver = 'CARVE'
+            bpy.data.objects['scan'].modifiers['Customizations'].object = bpy.data.objects['customizations']
+        except:
+            pass
+
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.context.scene.objects.active = bpy.data.objects['preview']
+    bpy.ops.object.modifier_add(type='BOOLEAN')
+    bpy.data.objects['preview'].modifiers['Boolean'].name = 'scan'
+    bpy.data.objects['preview'].modifiers['scan'].operation = 'DIFFERENCE'
+    bpy.data.objects['preview'].modifiers['scan'].solver = 'CARVE'
+    bpy.data.objects['preview'].modifiers['scan'].object = bpy.data.objects['scan']
+
+
+def carve_customizations(preview, customizations, carved):
+    readstl(preview, 'preview')
+    readstl(customizations, 'customizations')
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.context.scene.objects.active = bpy.data.objects['preview']
+    bpy.ops.object.modifier_add(type='BOOLEAN')
+    bpy.data.objects['preview'].modifiers['Boolean'].name = 'customizations'
+    bpy.data.objects['preview'].modifiers['customizations'].operation = 'DIFFERENCE'
+    bpy.data.objects['preview'].modifiers['customizations'].solver = 'CARVE'
+    bpy.data.objects['preview'].modifiers['customizations'].object = bpy.data.objects['customizations']
+    export_case(carved)
+
+
+def export_case(path):
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.data.objects['preview'].select = True
+    bpy.ops.export_mesh.stl(filepath=path, use_selection=True)
+
+
+def cut_parts(tempdir, nparts, names=None):
+    radius = 99.9 if nparts == 4 else 199.9
+    for name, loc, rotations, translation in part_layout(nparts):
+        if names is not None and name not in names:
+            continue
+        intersect_cube(name, loc, radius)
+        for angle, axis in rotations:
+            bpy.ops.transform.rotate(value=angle, axis=axis)
+        if any(translation):
+            bpy.ops.transform.translate(value=translation)
+        bpy.ops.export_mesh.stl(filepath=os.path.join(tempdir, name + '.stl'), use_selection=True)
+
+
+def carve(preview, scan, customizations, tempdir, nparts, shrinking_factor,
+          cache=None):
+    carve_case(preview, scan, customizations, shrinking_factor, cache)
+    # the whole case, to measure its clearance around the scan
+    export_case(os.path.join(tempdir, 'carved.stl'))
+    cut_parts(tempdir, nparts)
+"""
+
+blender_carve_model_template = blender_carve_functions + """
+
+bpy.context.scene.objects.active = bpy.data.objects['Cube']
+bpy.ops.object.delete()
+
+carve('{preview}', '{scan}', '{customizations}', '{tempdir}', {nparts},
+      {shrinking_factor})
+"""
+
+# Carve the case once and export it, so that the parts can be cut from the
+# exported case by several Blender processes with `blender_cut_parts_template`.
+blender_carve_case_template = blender_carve_functions + """
+
+bpy.context.scene.objects.active = bpy.data.objects['Cube']
+bpy.ops.object.delete()
+
+carve_case('{preview}', '{scan}', '{customizations}', {shrinking_factor})
+export_case('{carved}')
+"""
+
+blender_cut_parts_template = blender_carve_functions + """
+
+bpy.context.scene.objects.active = bpy.data.objects['Cube']
+bpy.ops.object.delete()
+
+readstl('{carved}', 'preview')
+cut_parts('{tempdir}', {nparts}, {names})
+"""
+
+# Carve the customizations out of a coil template, which is then used as the
+# template of `blender_carve_model_template` with no customizations.
+blender_precarve_template = blender_carve_functions + """
+
+bpy.context.scene.objects.active = bpy.data.objects['Cube']
+bpy.ops.object.delete()
+
+carve_customizations('{preview}', '{customizations}', '{carved}')
+"""
+
+# Long-lived worker: connects to the port given after `--` on the command line,
+# then carves one headcase per line of JSON parameters (those of
+# `blender_carve_model_template`), answering each with a line of JSON. The coil
+# templates and customizations stay loaded between jobs, and the scene is
+# emptied before each job.
+blender_worker_template = blender_carve_functions + """
+import json
+import socket
+import traceback
+
+
+def reset_scene():
+    if bpy.context.object is not None and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj, do_unlink=True)
+    for mesh in list(bpy.data.meshes):
+        if mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+
+
+def serve(port):
+    cache = dict()
+    conn = socket.create_connection(('127.0.0.1', port))
+    stream = conn.makefile('rw')
+    for line in stream:
+        job = json.loads(line)
+        if job.get('command') == 'quit':
+            break
+        try:
+            reset_scene()
+            carve(cache=cache, **job)
+            reply = dict(ok=True)
+        except Exception:
+            reply = dict(ok=False, error=traceback.format_exc())
+        stream.write(json.dumps(reply) + '\\n')
+        stream.flush()
+    conn.close()
+
+
+serve(int(sys.argv[sys.argv.index('--') + 1]))
+"""
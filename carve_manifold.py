@@ -0,0 +1,203 @@
+"""Carve a headcase in-process with the manifold3d boolean library.
+
+This backend runs the same sequence of operations as
+`blender_code.blender_carve_model_template`, on numpy arrays and without
+starting Blender:
+
+1. repair the scan by merging its coincident vertices,
+2. displace the scan along its vertex normals,
+3. union the scan with the customizations,
+4. subtract the result from the coil template, and
+5. intersect the carved template with one box per part, then move each part
+   to its printing orientation and export it as an STL file.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from autocase3d.util import read_stl, write_stl
+
+# Cutting boxes of each part, as in the Blender template: name, center of the
+# box, and the rotations (angle, axis) and translation applied to the part
+# before export. Rotations are about the center of the box.
+PART_LAYOUT = {
+    4: [
+        ("front_bottom", (0, -20, 100), [(np.pi / 2, (-1, 0, 0))], (0, 0, 0)),
+        ("back_bottom", (0, -20, -100), [(np.pi / 2, (-1, 0, 0))], (0, 0, 200)),
+        ("front_top", (0, 180, 100), [], (0, 0, 0)),
+        ("back_top", (0, 180, -100), [(np.pi, (-1, 0, 0))], (0, 0, 0)),
+    ],
+    2: [
+        ("front", (0, 0, 200), [(np.pi / 2, (-1, 0, 0))], (0, 0, 0)),
+        ("back", (0, 0, -200), [(np.pi / 2, (-1, 0, 0))], (0, 0, 0)),
+    ],
+}
+# Half-size of the cutting boxes.
+PART_RADIUS = {4: 99.9, 2: 199.9}
+
+
+def _to_manifold(pts, polys, name, merge=False):
+    """Build a Manifold from vertex and face arrays.
+
+    With `merge`, vertices at the same position are merged first, which closes
+    meshes whose faces do not share their vertices (e.g., read from a file that
+    duplicates them). Nothing else is changed, unlike the `remove_doubles` of
+    the Blender template, which merges vertices up to 0.75 mm apart.
+    """
+    import manifold3d
+
+    mesh = manifold3d.Mesh64(
+        vert_properties=np.ascontiguousarray(pts, dtype=np.double),
+        tri_verts=np.ascontiguousarray(polys, dtype=np.uint64),
+    )
+    if merge:
+        mesh.merge()
+    solid = manifold3d.Manifold(mesh)
+    if solid.status() != manifold3d.Error.NoError:
+        raise ValueError(f"The {name} mesh is not a closed manifold: {solid.status()}")
+    return solid
+
+
+def _from_manifold(solid):
+    """Vertex and face arrays of a Manifold."""
+    mesh = solid.to_mesh64()
+    pts = np.asarray(mesh.vert_properties)[:, :3].astype(np.double)
+    return pts, np.asarray(mesh.tri_verts).astype(np.int64)
+
+
+def vertex_normals(pts, polys):
+    """Unit vertex normals, averaged from the area-weighted face normals."""
+    tris = pts[polys]
+    face_normals = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    normals = np.zeros_like(pts)
+    for corner in range(3):
+        np.add.at(normals, polys[:, corner], face_normals)
+    norms = np.linalg.norm(normals, axis=1)
+    norms[norms == 0] = 1
+    return normals / norms[:, np.newaxis]
+
+
+def rotation_matrix(angle, axis):
+    """Matrix rotating column vectors by `angle` about `axis` (right-hand rule)."""
+    axis = np.asarray(axis, dtype=np.double)
+    x, y, z = axis / np.linalg.norm(axis)
+    cross = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    return (
+        np.eye(3) + np.sin(angle) * cross + (1 - np.cos(angle)) * cross.dot(cross)
+    )
+
+
+def place_part(pts, center, rotations, translation):
+    """Move the vertices of a part to its printing orientation."""
+    center = np.asarray(center, dtype=np.double)
+    for angle, axis in rotations:
+        pts = (pts - center).dot(rotation_matrix(angle, axis).T) + center
+    return pts + np.asarray(translation, dtype=np.double)
+
+
+def read_mesh(path):
+    """Read a mesh from an STL file, or from a .npz file of `pts` and `polys`.
+
+    A mesh given as a tuple of vertices and faces is returned as is.
+    """
+    if not isinstance(path, str):
+        return path
+    if path.endswith(".npz"):
+        with np.load(path) as npz:
+            return npz["pts"], npz["polys"]
+    return read_stl(path)
+
+
+def _read_customizations(path):
+    """Read the customizations as one solid.
+
+    The customizations may be several closed surfaces that overlap, which
+    Blender unions but manifold would count twice, leaving inside-out regions
+    once they are subtracted from the template.
+    """
+    import manifold3d
+
+    solid = _to_manifold(*read_stl(path), "customizations")
+    shells = solid.decompose()
+    if len(shells) == 1:
+        return solid
+    return manifold3d.Manifold.batch_boolean(shells, manifold3d.OpType.Add)
+
+
+def carve_customizations(preview, customizations):
+    """Carve the customizations out of the coil template.
+
+    Returns the vertices and faces of the carved template, which can be used
+    as the template of `carve_case` with no customizations.
+    """
+    template = _to_manifold(*read_mesh(preview), "template")
+    return _from_manifold(template - _read_customizations(customizations))
+
+
+def carve_case(preview, scan, customizations, shrinking_factor):
+    """Carve the scan and the customizations out of the coil template.
+
+    The scan is the path of an STL file, or its vertices and faces. Returns the
+    vertices and faces of the carved template.
+    """
+    template = _to_manifold(*read_mesh(preview), "template")
+
+    pts, polys = read_mesh(scan)
+    head = _to_manifold(pts, polys, "scan", merge=True)
+    pts, polys = _from_manifold(head)
+    pts = pts + shrinking_factor * vertex_normals(pts, polys)
+    head = _to_manifold(pts, polys, "displaced scan")
+
+    if os.path.exists(customizations):
+        head = head + _read_customizations(customizations)
+
+    return _from_manifold(template - head)
+
+
+def _cut_part(pts, polys, tempdir, radius, name, center, rotations, translation):
+    """Cut one part out of the carved template and export it."""
+    import manifold3d
+
+    case = _to_manifold(pts, polys, "carved template")
+    box = manifold3d.Manifold.cube((2 * radius,) * 3, center=True).translate(center)
+    pts, polys = _from_manifold(case ^ box)
+    pts = place_part(pts, center, rotations, translation)
+    write_stl(os.path.join(tempdir, f"{name}.stl"), pts, polys)
+
+
+def cut_parts(pts, polys, tempdir, nparts, n_jobs=1):
+    """Intersect the carved template with the cutting boxes and export the parts.
+
+    With `n_jobs` > 1, the parts are cut concurrently in that many processes.
+    """
+    radius = PART_RADIUS[nparts]
+    if n_jobs == 1:
+        for part in PART_LAYOUT[nparts]:
+            _cut_part(pts, polys, tempdir, radius, *part)
+        return
+
+    with ProcessPoolExecutor(n_jobs) as pool:
+        futures = [
+            pool.submit(_cut_part, pts, polys, tempdir, radius, *part)
+            for part in PART_LAYOUT[nparts]
+        ]
+        for future in futures:
+            future.result()
+
+
+def carve_model(
+    preview, scan, customizations, tempdir, nparts, shrinking_factor, n_jobs=1
+):
+    """Carve a headcase and save its parts in `tempdir`.
+
+    Takes the same parameters as `blender_code.blender_carve_model_template`,
+    and the number of processes used to cut the parts. The scan can also be
+    given as its vertices and faces.
+
+    Returns the vertices and faces of the carved case, before it is cut into
+    parts.
+    """
+    pts, polys = carve_case(preview, scan, customizations, shrinking_factor)
+    cut_parts(pts, polys, tempdir, nparts, n_jobs=n_jobs)
+    return pts, polys
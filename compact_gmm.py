@@ -0,0 +1,87 @@
+"""Write the GMM head model used for alignment in a compact format.
+
+The compact format keeps only the parameters used to evaluate the likelihood
+(means, Cholesky factors of the precisions, log-weights and log-determinants),
+stored uncompressed so that they can be memory-mapped, optionally as float32
+(the alignment evaluates them in float64 anyway).
+Components whose weight is below --min-weight can also be dropped, the weights
+of the others being scaled to sum to one.
+
+The average log-likelihood of samples drawn from the original model, and of
+the features of aligned head models passed with --scans, is reported under both
+models. The compact model is then used with `make_headcase.py --align-model`.
+"""
+import argparse
+
+import numpy as np
+
+from autocase3d import squash_features
+from autocase3d.fmin_autograd import (
+    GMM_PARAMS_FILE,
+    _load_gmm_model,
+    _log_likelihood,
+    save_gmm_model,
+)
+from autocase3d.util import get_features, read_stl
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("outfile", type=str, help="Compact model file (.npz)")
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=GMM_PARAMS_FILE,
+        help=f"GMM head model to convert. Default: {GMM_PARAMS_FILE}",
+    )
+    parser.add_argument(
+        "--min-weight",
+        type=float,
+        default=0.0,
+        help="Drop the components whose weight is below this value. Default: 0 "
+        "(keep all the components)",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Store the parameters as float32, which halves the size of the model. "
+        "The alignment still evaluates it in float64.",
+    )
+    parser.add_argument(
+        "--n-samples",
+        type=int,
+        default=100000,
+        help="Number of samples drawn from the original model to compare the "
+        "models. Default: 100000",
+    )
+    parser.add_argument(
+        "--scans",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Aligned head models (STL files, e.g. 02aligned.stl) whose features "
+        "are also used to compare the models",
+    )
+    args = parser.parse_args()
+
+    gmm, means, stds = _load_gmm_model(args.model)
+    compact = gmm.prune(args.min_weight)
+    if args.float32:
+        compact = compact.astype(np.float32)
+    save_gmm_model(args.outfile, compact, means, stds)
+
+    removed = gmm.weights_[gmm.weights_ < args.min_weight].sum()
+    print(
+        f"Kept {compact.n_components} of {gmm.n_components} components "
+        f"(removed weight {removed:.4f}), stored as {compact.dtype}"
+    )
+    datasets = [("samples", gmm.sample(args.n_samples))]
+    for scan in args.scans:
+        feats, _ = get_features(*read_stl(scan))
+        datasets.append((scan, squash_features(feats, means, stds)))
+    for name, feats in datasets:
+        original = _log_likelihood(feats, gmm)
+        change = _log_likelihood(feats, compact) - original
+        print(
+            f"{name}: average log-likelihood {original.mean():.4f}, change "
+            f"{change.mean():+.2e} (largest {np.abs(change).max():.2e})"
+        )
@@ -1,138 +1,401 @@
 """Generate an MRI-compatible headcase from a 3D head model acquired with a Structure Sensor."""
 
 import argparse
+import cProfile
+import json
 import os
 import shlex
 import shutil
+import socket
 import subprocess as sp
+import sys
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib import metadata
 from tempfile import NamedTemporaryFile as Temp
 from tempfile import mkdtemp
 
-import pymeshlab
+import numpy as np
 from packaging.version import Version
 
-from blender_code import blender_carve_model_template
+from autocase3d import instrument
+from blender_code import (
+    blender_carve_case_template,
+    blender_carve_model_template,
+    blender_cut_parts_template,
+    blender_precarve_template,
+    blender_worker_template,
+)
 
 cwd, _ = os.path.split(__file__)
 DEFAULT_CUSTOMIZATIONS = os.path.join(cwd, "stls", "default_customizations.stl")
+# Settings of the screened Poisson surface reconstruction in `model_clean`. Its
+# octree depth is chosen by `poisson_depth`, within POISSON_DEPTHS.
+POISSON_PARAMS = dict(fulldepth=2, samplespernode=1, preclean=True)
+POISSON_DEPTHS = (6, 11)
+# Ratio of the size of the Poisson octree to the size of the mesh (the default
+# `scale` of the filter).
+POISSON_SCALE = 1.1
+# Quality settings of `model_clean`: target edge length (in mm) of the Poisson
+# reconstruction, and number of faces of the decimated head model (None to
+# keep all the faces of the reconstruction). The full quality gives the largest
+# depth of POISSON_DEPTHS (11) for heads of 200 to 300 mm sampled finely
+# enough.
+CLEAN_QUALITY = dict(
+    full=dict(edge_length=0.125, n_faces=None),
+    preview=dict(edge_length=2.0, n_faces=50000),
+)
+# Name of the file recording the inputs and outputs of each stage of `pipeline`
+# in the working directory.
+MANIFEST_FILE = "manifest.json"
+CASE_FILES = dict(
+    s32="s32.stl", s64="s64.stl", n32="n32.stl", meg_ctf275="meg_ctf275.stl"
+)
+# Size limit of the cache of coil templates with the customizations carved out.
+TEMPLATE_CACHE_MAX_BYTES = 1 << 28
+# Version of the carved templates, to bump when carving them changes so that
+# the templates cached by previous versions are not used.
+TEMPLATE_CACHE_VERSION = 2
+# Largest deviation (in mm) of the scan decimated before carving (see
+# `decimate_scan`) from the original scan, well below the resolution of 3D
+# printers.
+DECIMATE_MAX_ERROR = 0.1
+# Fit report of the headcases (see `case_clearance`): scan vertices farther than
+# CLEARANCE_MAX_DISTANCE (in mm) from the headcase are not covered by it, and
+# the regions of the scan closer than CLEARANCE_THRESHOLD to the headcase
+# (negative when the headcase cuts into the scan) are reported as too tight.
+CLEARANCE_MAX_DISTANCE = 5.0
+CLEARANCE_THRESHOLD = 0.0
+CLEARANCE_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+# Pre-flight check of the aligned scans (see `preflight_check`): number of scan
+# vertices checked, and largest fraction of the scan outside of the coil
+# template, overflow (in mm) of the bounding box of the scan beyond the one of
+# the template, and depth (in mm) of the scan outside of the template. Well
+# aligned scans stick out of the template only through its face opening, by
+# the height of the nose.
+PREFLIGHT_POINTS = 5000
+PREFLIGHT_MAX_OUTSIDE = 0.2
+PREFLIGHT_MAX_OVERFLOW = 15.0
+PREFLIGHT_MAX_DEPTH = 40.0
+PART_FILES = {
+    2: ["back.stl", "front.stl"],
+    4: ["back_bottom.stl", "back_top.stl", "front_bottom.stl", "front_top.stl"],
+}
 
 
 def _call_blender(code):
     """Call blender, while running the given code. If the filename doesn't exist,
     save a new file in that location. New files will be initially cleared by deleting
     all objects.
+
+    The output of Blender is printed as it runs, and recorded with its run time
+    as a "blender" event of `autocase3d.instrument`.
     """
     with Temp(mode="w") as tf:
-        cmd = "blender -b -P {script}".format(script=tf.name)
+        cmd = "blender -b --python-exit-code 1 -P {script}".format(script=tf.name)
 
         tf.write(code)
         tf.flush()
-        sp.call(shlex.split(cmd))
+        start = time.perf_counter()
+        log = []
+        with sp.Popen(
+            shlex.split(cmd), stdout=sp.PIPE, stderr=sp.STDOUT, text=True
+        ) as process:
+            for line in process.stdout:
+                sys.stdout.write(line)
+                log.append(line)
+        instrument.record(
+            "blender",
+            "blender",
+            seconds=time.perf_counter() - start,
+            returncode=process.returncode,
+            log="".join(log),
+        )
+        if process.returncode != 0:
+            raise sp.CalledProcessError(process.returncode, cmd, "".join(log))
+
+
+def _call_blender_parallel(carve_params, n_jobs):
+    """Carve the case with Blender once, then cut its parts in `n_jobs` Blender
+    processes running concurrently, at most one per part.
+    """
+    carved = os.path.join(carve_params["tempdir"], "carved.stl")
+    _call_blender(blender_carve_case_template.format(carved=carved, **carve_params))
+    names = [fn[:-4] for fn in PART_FILES[carve_params["nparts"]]]
+    # more processes than parts would have nothing to cut
+    n_jobs = min(n_jobs, len(names))
+    codes = [
+        blender_cut_parts_template.format(
+            carved=carved,
+            tempdir=carve_params["tempdir"],
+            nparts=carve_params["nparts"],
+            names=names[i::n_jobs],
+        )
+        for i in range(n_jobs)
+    ]
+    with ThreadPoolExecutor(n_jobs) as pool:
+        list(pool.map(_call_blender, codes))
+
+
+class BlenderWorker:
+    """Long-lived Blender process that carves headcases.
+
+    Blender is started once, and the coil templates and customizations stay
+    loaded between jobs, so carving many headcases does not pay for the start
+    of Blender and the import of the templates every time. Jobs are sent to the
+    worker over a localhost socket, and the scene is emptied before each job.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Time (in seconds) to wait for Blender to start. Default is 60.
+
+    Examples
+    --------
+    >>> with BlenderWorker() as worker:
+    ...     gen_case("02aligned.stl", "head_case.zip", blender_worker=worker)
+    """
+
+    def __init__(self, timeout=60):
+        self._script = Temp(mode="w", suffix=".py")
+        self._script.write(blender_worker_template)
+        self._script.flush()
+        with socket.create_server(("127.0.0.1", 0)) as server:
+            server.settimeout(timeout)
+            port = server.getsockname()[1]
+            self._process = sp.Popen(
+                ["blender", "-b", "--python-exit-code", "1", "-P", self._script.name]
+                + ["--", str(port)]
+            )
+            try:
+                self._conn, _ = server.accept()
+            except socket.timeout:
+                self._process.kill()
+                self._script.close()
+                raise RuntimeError("Blender worker did not start")
+        self._stream = self._conn.makefile("rw")
+
+    def carve(self, **carve_params):
+        """Carve a headcase, with the parameters of `blender_carve_model_template`."""
+        start = time.perf_counter()
+        self._stream.write(json.dumps(carve_params) + "\n")
+        self._stream.flush()
+        line = self._stream.readline()
+        instrument.record("blender", "worker", seconds=time.perf_counter() - start)
+        if not line:
+            raise RuntimeError("Blender worker exited unexpectedly")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise RuntimeError(
+                f"Blender failed to carve the headcase:\n{reply['error']}"
+            )
+
+    def close(self):
+        """Stop the Blender process."""
+        try:
+            self._stream.write(json.dumps(dict(command="quit")) + "\n")
+            self._stream.flush()
+        except OSError:
+            pass
+        self._conn.close()
+        self._process.wait()
+        self._script.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def poisson_depth(pts, polys, edge_length):
+    """
+    Octree depth of the Poisson reconstruction of a mesh for a target edge length.
+
+    The cells of the octree are about `edge_length` wide, or as wide as the
+    median edge of the mesh if it is sampled more coarsely, since finer cells
+    would only add faces and no detail. The depth is at most the largest of
+    `POISSON_DEPTHS`.
+
+    Parameters
+    ----------
+    pts : array, shape (n_vertices, 3)
+        Vertices of the mesh.
+    polys : array, shape (n_faces, 3)
+        Faces of the mesh.
+    edge_length : float or None
+        Target edge length, in the units of `pts`. If None, the cells are as
+        wide as the median edge of the mesh.
+
+    Returns
+    -------
+    int
+        Octree depth, within `POISSON_DEPTHS`.
+    """
+    edges = pts[polys] - pts[np.roll(polys, 1, axis=1)]
+    spacing = np.median(np.linalg.norm(edges, axis=-1))
+    if edge_length is not None:
+        spacing = max(edge_length, spacing)
+    size = POISSON_SCALE * np.ptp(pts, axis=0).max()
+    depth = int(np.round(np.log2(size / spacing)))
+    return int(np.clip(depth, *POISSON_DEPTHS))
+
+
+def _apply_filter(ms, filter_name, **params):
+    """Apply a PyMeshLab filter, recording its run time and the mesh sizes."""
+    mesh = ms.current_mesh()
+    with instrument.timed(
+        "filter",
+        filter_name,
+        n_vertices=mesh.vertex_number(),
+        n_faces=mesh.face_number(),
+    ) as event:
+        result = ms.apply_filter(filter_name=filter_name, **params)
+        mesh = ms.current_mesh()
+        event["n_vertices_out"] = mesh.vertex_number()
+        event["n_faces_out"] = mesh.face_number()
+    return result
+
+
+def _current_poisson_depth(ms, edge_length):
+    """`poisson_depth` of the current mesh of a MeshSet."""
+    mesh = ms.current_mesh()
+    depth = poisson_depth(mesh.vertex_matrix(), mesh.face_matrix(), edge_length)
+    print(f"Poisson reconstruction with octree depth {depth}")
+    return depth
 
 
-def meshlab_filter(ms):
-    """Apply mesh filters to clean and process a 3D model using PyMeshLab."""
+def meshlab_filter(
+    ms, edge_length=CLEAN_QUALITY["full"]["edge_length"], n_faces=None
+):
+    """Apply mesh filters to clean and process a 3D model using PyMeshLab.
+
+    The Poisson reconstruction aims at edges of `edge_length` mm, or at the
+    edges of the head model if None (see `poisson_depth`), and the result is
+    decimated to `n_faces` faces if given.
+    """
+    Percentage, AbsoluteValue = _meshlab_value_types()
     # "Transform: Move, Translate, Center"
-    ms.apply_filter(filter_name="compute_matrix_from_translation")
+    _apply_filter(ms, filter_name="compute_matrix_from_translation")
     # "Transform: Rotate"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="compute_matrix_from_rotation",
         rotaxis="Z axis",
         rotcenter="barycenter",
         angle=0,
     )
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="compute_matrix_from_scaling_or_normalization",
         axisx=1000,
         scalecenter="barycenter",
         unitflag=False,
     )
     # "Merge Close Vertices"
-    ms.apply_filter(
-        filter_name="meshing_merge_close_vertices", threshold=pymeshlab.Percentage(0.5)
+    _apply_filter(
+        ms, filter_name="meshing_merge_close_vertices", threshold=Percentage(0.5)
     )
     # "Remove Isolated pieces (wrt Diameter)"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="meshing_remove_connected_component_by_diameter",
-        mincomponentdiag=pymeshlab.AbsoluteValue(150),
+        mincomponentdiag=AbsoluteValue(150),
         removeunref=True,
     )
     # "Remove Faces from Non Manifold Edges"
-    ms.apply_filter(
-        filter_name="meshing_repair_non_manifold_edges", method="Remove Faces"
+    _apply_filter(
+        ms, filter_name="meshing_repair_non_manifold_edges", method="Remove Faces"
     )
     # "Close Holes"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="meshing_close_holes",
         maxholesize=100,
         newfaceselected=False,
     )
     # "Surface Reconstruction: Poisson"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="generate_surface_reconstruction_screened_poisson",
-        depth=11,
-        fulldepth=2,
-        samplespernode=1,
-        # pointweight=0,
-        preclean=True,
+        depth=_current_poisson_depth(ms, edge_length),
+        **POISSON_PARAMS,
     )
     # "Vertex Attribute Transfer"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="transfer_attributes_per_vertex",
         sourcemesh=1,
         targetmesh=0,
         geomtransfer=True,
         colortransfer=False,
-        upperbound=pymeshlab.Percentage(8.631),
+        upperbound=Percentage(8.631),
     )
+    if n_faces is not None and ms.current_mesh().face_number() > n_faces:
+        # "Simplification: Quadric Edge Collapse Decimation"
+        _apply_filter(
+            ms,
+            filter_name="meshing_decimation_quadric_edge_collapse",
+            targetfacenum=n_faces,
+            preservenormal=True,
+        )
     return ms
 
 
-def meshlab_filter_pre2022(ms):
-    """Apply mesh filters to clean and process a 3D model using PyMeshLab (pre-2022)."""
+def meshlab_filter_pre2022(
+    ms, edge_length=CLEAN_QUALITY["full"]["edge_length"], n_faces=None
+):
+    """Apply mesh filters to clean and process a 3D model using PyMeshLab (pre-2022).
+
+    See `meshlab_filter` for the parameters.
+    """
     # "Transform: Move, Translate, Center"
-    ms.apply_filter(filter_name="transform_translate_center_set_origin")
+    _apply_filter(ms, filter_name="transform_translate_center_set_origin")
     # "Transform: Rotate"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="transform_rotate",
         rotaxis="Z axis",
         rotcenter="barycenter",
         angle=0,
     )
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="transform_scale_normalize",
         axisx=1000,
         scalecenter="barycenter",
         unitflag=False,
     )
     # "Merge Close Vertices"
-    ms.apply_filter(filter_name="merge_close_vertices", threshold=0.5)
+    _apply_filter(ms, filter_name="merge_close_vertices", threshold=0.5)
     # "Remove Isolated pieces (wrt Diameter)"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="remove_isolated_pieces_wrt_diameter",
         mincomponentdiag=150,
         removeunref=True,
     )
     # "Remove Faces from Non Manifold Edges"
-    ms.apply_filter(filter_name="repair_non_manifold_edges_by_removing_faces")
+    _apply_filter(ms, filter_name="repair_non_manifold_edges_by_removing_faces")
     # "Close Holes"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="close_holes",
         maxholesize=100,
         newfaceselected=False,
     )
     # "Surface Reconstruction: Poisson"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="surface_reconstruction_screened_poisson",
-        depth=11,
-        fulldepth=2,
-        samplespernode=1,
-        # pointweight=0,
-        preclean=True,
+        depth=_current_poisson_depth(ms, edge_length),
+        **POISSON_PARAMS,
     )
     # "Vertex Attribute Transfer"
-    ms.apply_filter(
+    _apply_filter(
+        ms,
         filter_name="vertex_attribute_transfer",
         sourcemesh=1,
         targetmesh=0,
@@ -140,10 +403,18 @@ def meshlab_filter_pre2022(ms):
         colortransfer=False,
         upperbound=8.631,
     )
+    if n_faces is not None and ms.current_mesh().face_number() > n_faces:
+        # "Simplification: Quadric Edge Collapse Decimation"
+        _apply_filter(
+            ms,
+            filter_name="simplification_quadric_edge_collapse_decimation",
+            targetfacenum=n_faces,
+            preservenormal=True,
+        )
     return ms
 
 
-def model_clean(infile, outfile):
+def model_clean(infile, outfile, quality="full"):
     """
     Clean and process a 3D model file.
 
@@ -152,72 +423,417 @@ def model_clean(infile, outfile):
     infile : str
         The input file path of the 3D model. It can be a zip file containing the model
         or a direct path to the model file.
-    outfile : str
-        The output file path to save the cleaned and processed 3D model.
+    outfile : str or None
+        The output file path to save the cleaned and processed 3D model. If None,
+        the model is only returned.
+    quality : str, optional
+        Quality of the cleaned model, 'full' (default) for the headcase to print,
+        or 'preview' for a coarser and decimated model that is quicker to clean,
+        align and carve, e.g. to check the fit of the headcase. See
+        `CLEAN_QUALITY`.
 
     Notes
     -----
     This function cleans and processes a 3D model file using PyMeshLab.
-    If the input file is a zip file, it will be extracted to a temporary directory
-    before processing. The cleaned and processed model will be saved to the specified
-    output file.
+    If the input file is a zip file, the vertices and faces of its `Model.obj` are
+    read directly from the archive, without extracting it. The cleaned and
+    processed model will be saved to the specified output file.
 
     The function checks the version of PyMeshLab installed and applies the appropriate
     mesh filters accordingly.
 
-    If the input file is a zip file, the temporary directory will be deleted after
-    processing.
+    Returns
+    -------
+    pts : array, shape (n_vertices, 3)
+        Vertices of the cleaned model.
+    polys : array, shape (n_faces, 3)
+        Faces of the cleaned model.
 
     Examples
     --------
     >>> model_clean("input.zip", "output.ply")
     """
 
-    clean_tmp = False
-    if infile.endswith("zip"):
-        path = mkdtemp()
-        pkg = zipfile.ZipFile(infile)
-        pkg.extractall(path)
-        pkg.close()
-        clean_tmp = True
+    import pymeshlab
+
+    with instrument.timed("stage", "clean", quality=quality) as event:
+        ms = pymeshlab.MeshSet(verbose=True)
+        if infile.endswith("zip"):
+            from autocase3d.util import read_obj
+
+            with zipfile.ZipFile(infile) as pkg, pkg.open("Model.obj") as fp:
+                pts, polys = read_obj(fp)
+            mesh = pymeshlab.Mesh(vertex_matrix=pts, face_matrix=polys)
+            ms.add_mesh(mesh, "Model")
+        else:
+            ms.load_new_mesh(os.path.abspath(infile))
+        event["n_vertices"] = ms.current_mesh().vertex_number()
+        event["n_faces"] = ms.current_mesh().face_number()
+        ms = meshlab_filter_plan()(ms, **CLEAN_QUALITY[quality])
+
+        if outfile is not None:
+            ms.save_current_mesh(outfile)
+        mesh = ms.current_mesh()
+        event["n_vertices_out"] = mesh.vertex_number()
+        event["n_faces_out"] = mesh.face_number()
+    return mesh.vertex_matrix(), mesh.face_matrix()
+
+
+def align_scan(
+    infile,
+    outfile,
+    levels=None,
+    grid_search=True,
+    n_jobs=1,
+    gmm_file=None,
+    subject=None,
+    warm_start=True,
+):
+    """
+    Automatically aligns a head scan and saves the aligned scan as an STL file.
+
+    Parameters
+    ----------
+    infile : str or tuple of arrays
+        The path to the input scan file, or the vertices and faces of the scan.
+    outfile : str or None
+        The path to save the aligned scan as an STL file. If None, the aligned
+        scan is only returned.
+    levels : sequence of int or None, optional
+        Coarse-to-fine alignment schedule, given as the number of vertices used
+        at each level (None for all vertices). Default is
+        `autocase3d.fmin_autograd.ALIGN_LEVELS`.
+    grid_search : bool, optional
+        Whether to also start the alignment from the best candidates of a grid
+        search over head orientations. Default is True.
+    n_jobs : int, optional
+        Number of processes used to refine the starting points. Default is 1.
+    gmm_file : str, optional
+        GMM head model the scan is aligned to. Default is
+        `autocase3d.fmin_autograd.GMM_PARAMS_FILE`.
+    subject : str, optional
+        Identifier of the subject. If given, the alignment is stored (see
+        `autocase3d.transforms`), and the alignment of the next scans of the
+        subject starts from it.
+    warm_start : bool, optional
+        Whether to start from the stored alignment of `subject`, if it was
+        made with the same GMM and its scan is compatible with this one (see
+        `autocase3d.transforms.fingerprint_mismatch`). The result is kept if
+        its score is close to the stored one, otherwise the scan is aligned
+        from the usual starting points. Default is True.
 
-        infile = os.path.join(path, "Model.obj")
+    Returns
+    -------
+    pts : array, shape (n_vertices, 3)
+        Vertices of the aligned scan.
+    polys : array, shape (n_faces, 3)
+        Faces of the aligned scan.
+    """
+    from autocase3d import cache, transforms
+    from autocase3d.fmin_autograd import ALIGN_LEVELS, GMM_PARAMS_FILE, fit_xfm_autograd
+    from autocase3d.util import load_ply, write_stl
+
+    if levels is None:
+        levels = ALIGN_LEVELS
+    if gmm_file is None:
+        gmm_file = GMM_PARAMS_FILE
+    with instrument.timed("stage", "align", levels=list(levels)) as event:
+        init = {}
+        if subject is not None:
+            scan = infile if isinstance(infile, str) else None
+            if scan is not None:
+                infile = load_ply(infile)
+            fingerprint = transforms.fingerprint(*infile)
+            gmm_hash = cache.hash_file(gmm_file)
+            stored = transforms.load_transform(subject) if warm_start else None
+            if stored is not None:
+                previous = stored["scan"] or "the previous scan of the subject"
+                reasons = transforms.fingerprint_mismatch(
+                    stored["fingerprint"], fingerprint
+                )
+                if stored["gmm"] != gmm_hash:
+                    reasons.append("it was aligned to another head model")
+                if reasons:
+                    print(
+                        f"Not starting from the alignment of {previous}, "
+                        f"since {' and '.join(reasons)}"
+                    )
+                else:
+                    print(f"Starting from the alignment of {previous}")
+                    init = dict(
+                        init=stored["params"],
+                        init_offset=np.subtract(
+                            fingerprint["centroid"], stored["fingerprint"]["centroid"]
+                        ),
+                        init_max_score=stored["score"] + transforms.MAX_SCORE_INCREASE,
+                    )
+            event["warm_start"] = bool(init)
+        new_pts, new_polys, opt_params, score = fit_xfm_autograd(
+            infile,
+            levels=levels,
+            grid_search=grid_search,
+            n_jobs=n_jobs,
+            gmm_file=gmm_file,
+            **init,
+        )
+        print("Final params: ", opt_params)
+        if subject is not None:
+            transforms.save_transform(
+                subject, opt_params, score, fingerprint, gmm_hash, scan=scan
+            )
+        event["n_vertices"] = len(new_pts)
+        event["n_faces"] = len(new_polys)
+        event["params"] = opt_params.tolist()
+        if outfile is not None:
+            write_stl(outfile, new_pts, new_polys)
+    return new_pts, new_polys
+
+
+def preflight_check(
+    scan,
+    casetype="s32",
+    abort=True,
+    max_outside=PREFLIGHT_MAX_OUTSIDE,
+    max_overflow=PREFLIGHT_MAX_OVERFLOW,
+    max_depth=PREFLIGHT_MAX_DEPTH,
+):
+    """
+    Check that an aligned scan fits in the coil template, before carving it.
+
+    A misaligned scan sticks out of the coil template, which is found in a
+    fraction of a second, while carving takes minutes. About `PREFLIGHT_POINTS`
+    vertices of the scan, spread uniformly over it, are tested for being inside
+    the template (see `autocase3d.distance.inside`), and the distance of those
+    outside of it to the template is measured.
+
+    Parameters
+    ----------
+    scan : str or tuple of arrays
+        Path to the aligned head model (.stl), or its vertices and faces.
+    casetype : str, optional
+        Type of head case, see `gen_case`. Default is 's32'.
+    abort : bool, optional
+        Whether to raise an error if the check fails. Default is True.
+    max_outside : float, optional
+        Largest fraction of the scan outside of the template. Default is
+        `PREFLIGHT_MAX_OUTSIDE`.
+    max_overflow : float, optional
+        Largest distance (in mm) by which the bounding box of the scan may
+        exceed the one of the template along each axis. Default is
+        `PREFLIGHT_MAX_OVERFLOW`.
+    max_depth : float, optional
+        Largest distance (in mm) of the scan outside of the template. Default is
+        `PREFLIGHT_MAX_DEPTH`.
+
+    Returns
+    -------
+    dict
+        `outside` (fraction of the scan outside of the template), `depth`
+        (largest distance of the scan outside of the template, infinite if
+        larger than `max_depth`), `overflow` (of the bounding box along each
+        axis) and the `failures` of the check.
+
+    Raises
+    ------
+    RuntimeError
+        If `abort` is True and the check failed.
+    """
+    from autocase3d.distance import inside, signed_distance
+    from autocase3d.util import read_stl, voxel_subsample
+
+    with instrument.timed("stage", "preflight", casetype=casetype) as event:
+        pts, _ = read_stl(scan) if isinstance(scan, str) else scan
+        casefile = os.path.join(cwd, "stls", CASE_FILES[casetype])
+        case_pts, case_polys = read_stl(casefile)
+        overflow = np.maximum(pts.max(0) - case_pts.max(0), 0)
+        overflow = np.maximum(overflow, case_pts.min(0) - pts.min(0))
+        index, weights = voxel_subsample(pts, PREFLIGHT_POINTS)
+        outside = ~inside(pts[index], case_pts, case_polys)
+        depth = 0.0
+        if outside.any():
+            distance, _ = signed_distance(
+                pts[index][outside], case_pts, case_polys, max_distance=max_depth
+            )
+            depth = float(np.abs(distance).max())
+        report = dict(
+            outside=float(weights[outside].sum() / weights.sum()),
+            depth=depth,
+            overflow=overflow.tolist(),
+            failures=[],
+        )
+        event.update(report)
+
+    if report["outside"] > max_outside:
+        report["failures"].append(
+            f"{100 * report['outside']:.0f}% of the head model is outside of the "
+            f"{casetype} template (at most {100 * max_outside:.0f}%)"
+        )
+    if overflow.max() > max_overflow:
+        report["failures"].append(
+            f"the head model extends {overflow.max():.1f} mm beyond the {casetype} "
+            f"template along {'xyz'[overflow.argmax()]} (at most {max_overflow} mm)"
+        )
+    if depth > max_depth:
+        report["failures"].append(
+            f"the head model sticks out of the {casetype} template by more than "
+            f"{max_depth} mm"
+        )
+    if depth <= max_depth:
+        extent = f"up to {depth:.1f} mm"
     else:
-        infile = os.path.abspath(infile)
-    ms = pymeshlab.MeshSet(verbose=True)
-    ms.load_new_mesh(infile)
+        extent = f"more than {max_depth} mm"
+    print(
+        f"Pre-flight check against the {casetype} template: "
+        f"{100 * report['outside']:.1f}% of the head model outside of it, by {extent}, "
+        "bounding box overflow "
+        + ", ".join(f"{axis} {value:.1f} mm" for axis, value in zip("xyz", overflow))
+    )
+    if report["failures"]:
+        message = "Pre-flight check failed, the head model is probably misaligned: "
+        message += "; ".join(report["failures"])
+        if abort:
+            raise RuntimeError(message)
+        print(message)
+    return report
+
+
+def decimate_scan(pts, polys, n_faces, max_error=DECIMATE_MAX_ERROR):
+    """
+    Decimate a scan with a bounded geometric error.
+
+    The scan is decimated by quadric edge collapse in steps that halve its
+    number of faces, down to `n_faces` faces. After each step, the Hausdorff
+    distance between the decimated and the original scans is measured on the
+    vertices of both, and the decimation stops at the last step whose distance
+    is within `max_error`.
+
+    Parameters
+    ----------
+    pts : array, shape (n_vertices, 3)
+        Vertices of the scan, in mm.
+    polys : array, shape (n_faces, 3)
+        Faces of the scan.
+    n_faces : int
+        Number of faces aimed at.
+    max_error : float, optional
+        Largest distance (in mm) allowed between the decimated and the original
+        scans. Default is `DECIMATE_MAX_ERROR`.
 
-    PYMESHLAB_VERSION = pymeshlab_version()
-    if PYMESHLAB_VERSION >= Version("2022.2"):
-        ms = meshlab_filter(ms)
+    Returns
+    -------
+    pts : array, shape (n_vertices, 3)
+        Vertices of the decimated scan.
+    polys : array, shape (n_faces, 3)
+        Faces of the decimated scan.
+    error : float
+        Hausdorff distance (in mm) between the decimated and the original scans.
+    """
+    import pymeshlab
+
+    if pymeshlab_version() >= Version("2022.2"):
+        decimation = "meshing_decimation_quadric_edge_collapse"
+        hausdorff = "get_hausdorff_distance"
     else:
-        ms = meshlab_filter_pre2022(ms)
+        decimation = "simplification_quadric_edge_collapse_decimation"
+        hausdorff = "hausdorff_distance"
+    targets = []
+    target = len(polys) // 2
+    while target > n_faces:
+        targets.append(target)
+        target //= 2
+    if n_faces < len(polys):
+        targets.append(n_faces)
 
-    ms.save_current_mesh(outfile)
-    if clean_tmp:
-        shutil.rmtree(path)
+    ms = pymeshlab.MeshSet()
+    ms.add_mesh(pymeshlab.Mesh(vertex_matrix=pts, face_matrix=polys), "scan")
+    ms.add_mesh(ms.mesh(0), "decimated")
+    decimated = ms.current_mesh_id()
+    result = pts, polys, 0.0
+    for target in targets:
+        _apply_filter(
+            ms, filter_name=decimation, targetfacenum=target, preservenormal=True
+        )
+        error = max(
+            _apply_filter(
+                ms,
+                filter_name=hausdorff,
+                sampledmesh=sampled,
+                targetmesh=reference,
+                samplevert=True,
+                samplenum=ms.mesh(sampled).vertex_number(),
+            )["max"]
+            for sampled, reference in [(0, decimated), (decimated, 0)]
+        )
+        ms.set_current_mesh(decimated)
+        if error > max_error:
+            print(f"Decimation to {target} faces deviates by {error:.3f} mm, stopping")
+            break
+        mesh = ms.current_mesh()
+        result = mesh.vertex_matrix(), mesh.face_matrix(), error
+    return result
 
 
-def align_scan(infile, outfile):
+def precarved_template(casetype, customizations, backend="blender"):
     """
-    Automatically aligns a head scan and saves the aligned scan as an STL file.
+    Return the coil template with the customizations carved out.
+
+    Carving the customizations out of the template is the same for every
+    subject, so the carved template is built with `backend` on first use and
+    cached, keyed by the content of the coil template and customizations files.
 
     Parameters
     ----------
-    infile : str
-        The path to the input scan file.
-    outfile : str
-        The path to save the aligned scan as an STL file.
+    casetype : str
+        Type of head case, see `gen_case`.
+    customizations : str
+        Path to the customizations file.
+    backend : str, optional
+        Library used to carve the template, see `gen_case`. Default is 'blender'.
+
+    Returns
+    -------
+    str
+        Path to the carved template: an STL file for Blender, and a .npz file
+        of vertices and faces for manifold3d.
     """
-    from cortex import formats
+    from autocase3d import cache
+
+    casefile = os.path.join(cwd, "stls", CASE_FILES[casetype])
+    key = cache.hash_arrays(
+        template=cache.hash_file(casefile),
+        customizations=cache.hash_file(customizations),
+        backend=backend,
+        version=TEMPLATE_CACHE_VERSION,
+    )
+    extensions = dict(blender=".stl", manifold=".npz")
+    if backend not in extensions:
+        raise ValueError(f"Unknown carving backend: {backend}")
+    directory = cache.cache_dir("templates")
+    path = os.path.join(directory, key + extensions[backend])
+    if os.path.exists(path):
+        cache.touch(path)
+        return path
 
-    from autocase3d.fmin_autograd import fit_xfm_autograd
+    print(f"Carving the customizations out of the {casetype} template")
+    # keep the extension, which Blender uses to pick the file format
+    with cache.atomic_path(path, suffix=extensions[backend]) as tmp:
+        if backend == "blender":
+            _call_blender(
+                blender_precarve_template.format(
+                    preview=casefile, customizations=customizations, carved=tmp
+                )
+            )
+        else:
+            from carve_manifold import carve_customizations
 
-    new_pts, new_polys, opt_params = fit_xfm_autograd(infile)
-    print("Final params: ", opt_params)
-    formats.write_stl(outfile, new_pts, new_polys)
+            pts, polys = carve_customizations(casefile, customizations)
+            with open(tmp, "wb") as fp:
+                np.savez(fp, pts=pts, polys=polys)
+    cache.evict_lru(directory, TEMPLATE_CACHE_MAX_BYTES)
+    return path
 
 
+@instrument.timed("stage", "carve")
 def gen_case(
     scanfile,
     outfile,
@@ -225,14 +841,26 @@ def gen_case(
     casetype="s32",
     nparts=4,
     customizations=DEFAULT_CUSTOMIZATIONS,
-    expand_head_model=0.1):
+    expand_head_model=0.1,
+    backend="blender",
+    blender_worker=None,
+    n_jobs=None,
+    precarve=True,
+    decimate_faces=None,
+    decimate_max_error=DECIMATE_MAX_ERROR,
+    check_clearance=True,
+    clearance_threshold=CLEARANCE_THRESHOLD,
+    clearance_map=None,
+):
     """
     Generate a headcase.
 
     Parameters
     ----------
-    scanfile : str
-        Path to the cleaned and aligned head model.
+    scanfile : str or tuple of arrays
+        Path to the cleaned and aligned head model (.stl), or its vertices and
+        faces. Blender is given the vertices and faces in a binary STL file in
+        `workdir`.
     outfile : str
         Path to the output file where the generated head case will be saved.
     workdir : str, optional
@@ -250,6 +878,44 @@ def gen_case(
         Default is `default_customizations.stl` in the `stls` folder.
     expand_head_model : float, optional
         Factor (in mm) to expand the head model by. Default is 0.1.
+    backend : str, optional
+        Library used to carve the headcase. Possible values are 'blender' (run
+        Blender in a subprocess) and 'manifold' (run the boolean operations
+        in-process with manifold3d). Default is 'blender'.
+    blender_worker : BlenderWorker, optional
+        Running Blender process used by the 'blender' backend instead of
+        starting a new one. Useful when generating many headcases.
+    n_jobs : int, optional
+        Number of processes cutting the parts of the carved headcase
+        concurrently. Default is one per part, up to the number of CPUs. Not
+        used with `blender_worker`.
+    precarve : bool, optional
+        Whether to carve the scan out of a cached coil template with the
+        customizations already carved out (see `precarved_template`), rather
+        than carving the scan and the customizations out of the coil template.
+        Default is True.
+    decimate_faces : int, optional
+        Decimate the scan to this number of faces before carving it, within
+        `decimate_max_error` (see `decimate_scan`), since the boolean
+        operations get slower with the number of faces. By default, the scan
+        is carved as is.
+    decimate_max_error : float, optional
+        Largest deviation (in mm) of the decimated scan from the original one.
+        Default is `DECIMATE_MAX_ERROR`.
+    check_clearance : bool, optional
+        Whether to measure and print the clearance between the scan and the
+        carved headcase (see `case_clearance`). Default is True.
+    clearance_threshold : float, optional
+        Clearance (in mm) below which regions of the scan are reported. Default
+        is `CLEARANCE_THRESHOLD`.
+    clearance_map : str, optional
+        Path to a PLY file where the scan is saved with its vertices colored by
+        clearance. Not saved by default.
+
+    Returns
+    -------
+    dict or None
+        Clearance report of `case_clearance`, if `check_clearance` is True.
 
     Examples
     --------
@@ -257,17 +923,44 @@ def gen_case(
     """
 
     customizations = os.path.abspath(customizations)
-    casefile = dict(
-        s32="s32.stl", s64="s64.stl", n32="n32.stl", meg_ctf275="meg_ctf275.stl"
-    )
-    casefile = os.path.join(cwd, "stls", casefile[casetype])
+    casefile = os.path.join(cwd, "stls", CASE_FILES[casetype])
+    if precarve and os.path.exists(customizations):
+        casefile = precarved_template(casetype, customizations, backend=backend)
+        # the customizations are already carved out of the template
+        customizations = ""
 
     cleanup = False
     if workdir is None:
         workdir = mkdtemp()
         cleanup = True
+    if n_jobs is None:
+        n_jobs = min(nparts, os.cpu_count() or 1)
+    # the clearance is measured from the scan before decimation
+    scan = scanfile
+    if decimate_faces is not None:
+        from autocase3d.util import read_stl
 
-    blender_params = dict(
+        with instrument.timed("step", "decimate") as event:
+            pts, polys = read_stl(scanfile) if isinstance(scanfile, str) else scanfile
+            new_pts, new_polys, error = decimate_scan(
+                pts, polys, decimate_faces, decimate_max_error
+            )
+            event.update(
+                n_faces=len(polys), n_faces_out=len(new_polys), max_error=error
+            )
+        print(
+            f"Decimated the scan from {len(polys)} to {len(new_polys)} faces, "
+            f"deviating by at most {error:.3f} mm"
+        )
+        scanfile = new_pts, new_polys
+    if not isinstance(scanfile, str) and backend == "blender":
+        from autocase3d.util import write_stl
+
+        pts, polys = scanfile
+        scanfile = os.path.join(workdir, "scan.stl")
+        write_stl(scanfile, pts, polys)
+
+    carve_params = dict(
         preview=casefile,
         scan=scanfile,
         customizations=customizations,
@@ -275,24 +968,191 @@ def gen_case(
         nparts=nparts,
         shrinking_factor=expand_head_model,
     )
-    print("Generating head model by calling Blender with the following parameters:")
-    print(blender_params)
-    _call_blender(blender_carve_model_template.format(**blender_params))
+    if backend == "blender":
+        print("Generating head model by calling Blender with the following parameters:")
+        print(carve_params)
+        # the whole carved case, exported by Blender before cutting it
+        case = os.path.join(workdir, "carved.stl")
+        if blender_worker is not None:
+            blender_worker.carve(**carve_params)
+        elif n_jobs > 1:
+            _call_blender_parallel(carve_params, n_jobs)
+        else:
+            _call_blender(blender_carve_model_template.format(**carve_params))
+    elif backend == "manifold":
+        from carve_manifold import carve_model
+
+        print("Generating head model with manifold3d with the following parameters:")
+        if isinstance(scanfile, str):
+            print(carve_params)
+        else:
+            print(dict(carve_params, scan=f"<{len(scanfile[0])} vertices>"))
+        case = carve_model(**carve_params, n_jobs=n_jobs)
+    else:
+        raise ValueError(f"Unknown carving backend: {backend}")
 
-    pieces = {
-        2: ["back.stl", "front.stl"],
-        4: ["back_bottom.stl", "back_top.stl", "front_bottom.stl", "front_top.stl"],
-    }
     with zipfile.ZipFile(outfile, mode="w") as pkg:
-        for fn in pieces[nparts]:
+        for fn in PART_FILES[nparts]:
             pkg.write(os.path.join(workdir, fn), fn)
 
+    report = None
+    if check_clearance:
+        with instrument.timed("step", "clearance") as event:
+            report = case_clearance(
+                scan, case, clearance_threshold, plyfile=clearance_map
+            )
+            event.update(
+                {key: value for key, value in report.items() if key != "regions"},
+                n_regions=len(report["regions"]),
+            )
+        print_clearance(report)
+
     if cleanup:
         shutil.rmtree(workdir)
+    return report
+
+
+def case_clearance(scan, case, threshold=CLEARANCE_THRESHOLD, plyfile=None):
+    """
+    Measure the clearance between a scan and the headcase carved around it.
 
+    The signed distance from every vertex of the scan to the inner surface of
+    the headcase, before it is cut into parts, is computed (see
+    `autocase3d.distance.signed_distance`). It is positive where there is a gap
+    between the scan and the headcase, and negative where the headcase cuts
+    into the scan.
+
+    Parameters
+    ----------
+    scan : str or tuple of arrays
+        Path to the aligned head model (.stl), or its vertices and faces.
+    case : str or tuple of arrays
+        Path to the carved headcase (.stl), or its vertices and faces.
+    threshold : float, optional
+        Clearance (in mm) below which regions of the scan are reported. Default
+        is `CLEARANCE_THRESHOLD`.
+    plyfile : str, optional
+        If given, the scan is saved to this PLY file with its vertices colored
+        by clearance: red below `threshold`, from green to blue up to
+        `CLEARANCE_MAX_DISTANCE`, and gray where the scan is not covered by the
+        headcase.
+
+    Returns
+    -------
+    dict
+        `n_vertices` and `covered` (fraction of the scan vertices within
+        `CLEARANCE_MAX_DISTANCE` of the headcase), `percentiles` of the
+        clearance of the covered vertices, `below_threshold` (fraction of the
+        covered vertices), and the connected `regions` of the scan below the
+        threshold, largest first, with their number of vertices, minimum
+        clearance and center.
+    """
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+
+    from autocase3d.distance import signed_distance
+    from autocase3d.util import read_stl, write_ply
+
+    pts, polys = read_stl(scan) if isinstance(scan, str) else scan
+    case_pts, case_polys = read_stl(case) if isinstance(case, str) else case
+    # outside of the headcase is inside of its cavity, i.e., a gap
+    clearance, _ = signed_distance(
+        pts, case_pts, case_polys, max_distance=CLEARANCE_MAX_DISTANCE
+    )
 
+    covered = np.abs(clearance) <= CLEARANCE_MAX_DISTANCE
+    below = covered & (clearance < threshold)
+    report = dict(
+        n_vertices=len(pts),
+        covered=float(covered.mean()),
+        percentiles={
+            str(q): float(value)
+            for q, value in zip(
+                CLEARANCE_PERCENTILES,
+                np.percentile(clearance[covered], CLEARANCE_PERCENTILES)
+                if covered.any()
+                else [np.nan] * len(CLEARANCE_PERCENTILES),
+            )
+        },
+        below_threshold=float(below.sum() / max(covered.sum(), 1)),
+        threshold=threshold,
+        regions=[],
+    )
+    # regions: connected components of the mesh restricted to `below`
+    edges = np.vstack([polys[:, [0, 1]], polys[:, [1, 2]], polys[:, [2, 0]]])
+    edges = edges[below[edges].all(1)]
+    graph = sparse.coo_matrix(
+        (np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(pts),) * 2
+    )
+    _, labels = connected_components(graph, directed=False)
+    for label in np.unique(labels[below]):
+        region = np.flatnonzero(below & (labels == label))
+        report["regions"].append(
+            dict(
+                n_vertices=len(region),
+                min_clearance=float(clearance[region].min()),
+                center=pts[region].mean(0).tolist(),
+            )
+        )
+    report["regions"].sort(key=lambda region: -region["n_vertices"])
+
+    if plyfile is not None:
+        scale = np.clip(
+            (clearance - threshold) / (CLEARANCE_MAX_DISTANCE - threshold), 0, 1
+        )
+        colors = np.column_stack(
+            [np.zeros(len(pts)), 200 * (1 - scale), 255 * scale]
+        ).astype(np.uint8)
+        colors[below] = (255, 0, 0)
+        colors[~covered] = (128, 128, 128)
+        write_ply(plyfile, pts, polys, colors)
+    return report
+
+
+def print_clearance(report):
+    """Print a summary of the report of `case_clearance`."""
+    print(
+        f"Clearance between the head model and the headcase "
+        f"({100 * report['covered']:.0f}% of the head model covered):"
+    )
+    print(
+        "  "
+        + ", ".join(
+            f"{q}%: {value:.2f} mm" for q, value in report["percentiles"].items()
+        )
+    )
+    print(
+        f"  {100 * report['below_threshold']:.1f}% of the covered head model in "
+        f"{len(report['regions'])} regions below {report['threshold']} mm"
+    )
+    for region in report["regions"][:5]:
+        center = ", ".join(f"{x:.0f}" for x in region["center"])
+        print(
+            f"    {region['n_vertices']} vertices around ({center}), "
+            f"down to {region['min_clearance']:.2f} mm"
+        )
+    if report["percentiles"].get("50", 0) < 0:
+        print(
+            "  Warning: the headcase cuts into most of the head model, check the "
+            "alignment and --expand-head-model before printing it"
+        )
+
+
+def parse_align_levels(levels):
+    """Parse a comma-separated alignment schedule such as "2000,20000,full"."""
+    return tuple(
+        None if level.strip() == "full" else int(level) for level in levels.split(",")
+    )
+
+
+@lru_cache(maxsize=None)
 def pymeshlab_version():
     """Return the version of PyMeshLab installed."""
+    try:
+        return Version(metadata.version("pymeshlab"))
+    except metadata.PackageNotFoundError:
+        pass
+    # PyMeshLab built from source, without package metadata
     out = sp.check_output(
         [
             "python",
@@ -305,6 +1165,90 @@ def pymeshlab_version():
     return version
 
 
+@lru_cache(maxsize=None)
+def _meshlab_value_types():
+    """PyMeshLab types of the percentage and absolute values of filter
+    parameters, which were renamed in PyMeshLab 2023.12.
+    """
+    import pymeshlab
+
+    if pymeshlab_version() >= Version("2023.12"):
+        return pymeshlab.PercentageValue, pymeshlab.PureValue
+    return pymeshlab.Percentage, pymeshlab.AbsoluteValue
+
+
+@lru_cache(maxsize=None)
+def meshlab_filter_plan():
+    """Return the function applying the mesh filters of `model_clean` with the
+    filter names of the installed PyMeshLab version, which were renamed in
+    PyMeshLab 2022.2.
+    """
+    if pymeshlab_version() >= Version("2022.2"):
+        return meshlab_filter
+    return meshlab_filter_pre2022
+
+
+def _run_stage(workdir, stage, inputs, params, outputs, run, resume=True):
+    """
+    Run a stage of `pipeline`, unless its outputs in `workdir` are up to date.
+
+    The manifest file in `workdir` records the hashes of the input files, the
+    parameters, and the hashes of the output files of each stage. A stage is
+    skipped if it already ran with the same inputs and parameters, and its
+    outputs have not changed since.
+
+    Parameters
+    ----------
+    workdir : str
+        Working directory of the pipeline.
+    stage : str
+        Name of the stage.
+    inputs, outputs : dict
+        Paths of the input and output files of the stage, by name.
+    params : dict
+        Parameters of the stage, which must be serializable to JSON.
+    run : callable
+        Function running the stage.
+    resume : bool, optional
+        Whether to skip the stage if its outputs are up to date. Default is True.
+    """
+    from autocase3d.cache import atomic_path, hash_file
+
+    manifest_file = os.path.join(workdir, MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+
+    # round trip through JSON so that tuples compare equal to the stored lists
+    record = json.loads(
+        json.dumps(
+            dict(
+                inputs={name: hash_file(path) for name, path in inputs.items()},
+                params=params,
+            )
+        )
+    )
+    previous = manifest.get(stage, {})
+    if (
+        resume
+        and all(previous.get(key) == record[key] for key in ["inputs", "params"])
+        and all(
+            os.path.exists(path) and hash_file(path) == previous["outputs"].get(name)
+            for name, path in outputs.items()
+        )
+    ):
+        print(f"Skipping {stage}, the outputs in {workdir} are up to date")
+        instrument.record("stage", stage, skipped=True)
+        return
+
+    run()
+    record["outputs"] = {name: hash_file(path) for name, path in outputs.items()}
+    manifest[stage] = record
+    with atomic_path(manifest_file) as tmp, open(tmp, "w") as fp:
+        json.dump(manifest, fp, indent=2)
+
+
 def pipeline(
     infile,
     outfile,
@@ -313,6 +1257,22 @@ def pipeline(
     workdir=None,
     customizations=DEFAULT_CUSTOMIZATIONS,
     expand_head_model=0.1,
+    align_levels=None,
+    align_grid_search=True,
+    align_jobs=1,
+    align_model=None,
+    subject=None,
+    align_warm_start=True,
+    carve_backend="blender",
+    carve_jobs=None,
+    resume=True,
+    clean_quality="full",
+    decimate_faces=None,
+    decimate_max_error=DECIMATE_MAX_ERROR,
+    check_clearance=True,
+    clearance_threshold=CLEARANCE_THRESHOLD,
+    clearance_map=None,
+    preflight_abort=True,
 ):
     """
     Run the pipeline to generate a head case from a head model.
@@ -330,11 +1290,57 @@ def pipeline(
     nparts : int, optional
         Number of parts, default is 4.
     workdir : str, optional
-        Path to the working directory, default is None.
+        Path to the working directory where the intermediate head models are
+        saved, default is None.
     customizations : dict, optional
         Customizations for the head case, default is `default_customizations.stl`.
     expand_head_model : float, optional
         Factor (in mm) to expand the head model by, default is 0.1.
+    align_levels : sequence of int or None, optional
+        Coarse-to-fine alignment schedule passed to `align_scan`.
+    align_grid_search : bool, optional
+        Whether `align_scan` also starts from a grid search over head
+        orientations, default is True.
+    align_jobs : int, optional
+        Number of processes used by `align_scan`, default is 1.
+    align_model : str, optional
+        GMM head model used by `align_scan`, default is the one shipped in
+        `autocase3d`.
+    subject : str, optional
+        Identifier of the subject, whose alignments are stored by `align_scan`
+        to warm-start the alignment of their next scans, default is None.
+    align_warm_start : bool, optional
+        Whether `align_scan` starts from the stored alignment of `subject`,
+        default is True.
+    carve_backend : str, optional
+        Library used by `gen_case` to carve the headcase, default is "blender".
+    carve_jobs : int, optional
+        Number of processes used by `gen_case` to cut the parts of the
+        headcase, default is one per part.
+    resume : bool, optional
+        Whether to skip the stages whose outputs in `workdir` were produced from
+        the same inputs and parameters by an earlier run, default is True.
+    clean_quality : str, optional
+        Quality of the cleaned head model passed to `model_clean`, "full"
+        (default) or "preview".
+    decimate_faces : int, optional
+        Number of faces the aligned head model is decimated to before carving,
+        default is None (no decimation).
+    decimate_max_error : float, optional
+        Largest deviation (in mm) of the decimated head model from the aligned
+        one, default is `DECIMATE_MAX_ERROR`.
+    check_clearance : bool, optional
+        Whether `gen_case` reports the clearance between the aligned head model
+        and the headcase, default is True.
+    clearance_threshold : float, optional
+        Clearance (in mm) below which regions of the head model are reported,
+        default is `CLEARANCE_THRESHOLD`.
+    clearance_map : str, optional
+        Path to a PLY file where the aligned head model is saved with its
+        vertices colored by clearance, default is None (not saved).
+    preflight_abort : bool, optional
+        Whether to stop before carving if the aligned head model does not fit
+        in the coil template (see `preflight_check`), default is True.
 
     Notes
     -----
@@ -342,40 +1348,150 @@ def pipeline(
     1. If `workdir` is provided, creates the working directory if it does not exist.
     2. Cleans the head model by calling `model_clean` function.
     3. Aligns the cleaned head model by calling `align_scan` function.
-    4. Generates the head case by calling `gen_case` function.
-    5. If `workdir` is not provided, removes the working directory.
+    4. Checks that the aligned head model fits in the coil template by calling
+       `preflight_check` function.
+    5. Generates the head case by calling `gen_case` function.
+
+    If `workdir` is not provided, the head models are handed from one stage to the
+    next in memory, without writing intermediate files.
+
+    Otherwise, the intermediate head models are saved in the working directory, and
+    the hashes of the inputs and outputs of each stage, and its parameters, are
+    recorded in a manifest file, so that running the pipeline again with the same
+    `workdir` only reruns the stages whose inputs or parameters changed (see
+    `_run_stage`).
 
     Examples
     --------
     >>> pipeline("Model.zip", "Headcase.zip", casetype="s32", nparts=4)
     """
 
-    if workdir is not None:
-        working_dir = os.path.abspath(workdir)
-        os.makedirs(working_dir, exist_ok=True)
-        print(f"Intermediate files will be stored in in {working_dir}")
-    else:
-        working_dir = mkdtemp()
+    if workdir is None:
+        print("Cleaning head model")
+        cleaned = model_clean(infile, None, quality=clean_quality)
+        print("Aligning head model")
+        aligned = align_scan(
+            cleaned,
+            None,
+            levels=align_levels,
+            grid_search=align_grid_search,
+            n_jobs=align_jobs,
+            gmm_file=align_model,
+            subject=subject,
+            warm_start=align_warm_start,
+        )
+        preflight_check(aligned, casetype, abort=preflight_abort)
+        print("Making head case")
+        gen_case(
+            aligned,
+            outfile,
+            casetype=casetype,
+            nparts=nparts,
+            customizations=customizations,
+            expand_head_model=expand_head_model,
+            backend=carve_backend,
+            n_jobs=carve_jobs,
+            decimate_faces=decimate_faces,
+            decimate_max_error=decimate_max_error,
+            check_clearance=check_clearance,
+            clearance_threshold=clearance_threshold,
+            clearance_map=clearance_map,
+        )
+        return
+
+    working_dir = os.path.abspath(workdir)
+    os.makedirs(working_dir, exist_ok=True)
+    print(f"Intermediate files will be stored in in {working_dir}")
     cleaned = os.path.join(working_dir, "01cleaned.ply")
     aligned = os.path.join(working_dir, "02aligned.stl")
     print("Cleaning head model")
-    model_clean(infile, cleaned)
+    _run_stage(
+        working_dir,
+        "clean",
+        inputs=dict(infile=infile),
+        params=dict(
+            poisson=POISSON_PARAMS,
+            poisson_depths=POISSON_DEPTHS,
+            quality=CLEAN_QUALITY[clean_quality],
+            pymeshlab=str(pymeshlab_version()),
+        ),
+        outputs=dict(cleaned=cleaned),
+        run=lambda: model_clean(infile, cleaned, quality=clean_quality),
+        resume=resume,
+    )
     print("Aligning head model")
-    align_scan(cleaned, aligned)
+    from autocase3d.fmin_autograd import ALIGN_LEVELS, GMM_PARAMS_FILE
+
+    if align_model is None:
+        align_model = GMM_PARAMS_FILE
+    align_params = dict(
+        levels=ALIGN_LEVELS if align_levels is None else align_levels,
+        grid_search=align_grid_search,
+    )
+    if subject is not None:
+        align_params["subject"] = subject
+    _run_stage(
+        working_dir,
+        "align",
+        inputs=dict(cleaned=cleaned, gmm=align_model),
+        params=align_params,
+        outputs=dict(aligned=aligned),
+        run=lambda: align_scan(
+            cleaned,
+            aligned,
+            levels=align_levels,
+            grid_search=align_grid_search,
+            n_jobs=align_jobs,
+            gmm_file=align_model,
+            subject=subject,
+            warm_start=align_warm_start,
+        ),
+        resume=resume,
+    )
+    preflight_check(aligned, casetype, abort=preflight_abort)
     print("Making head case")
-    gen_case(
-        aligned,
-        outfile,
+    carve_inputs = dict(
+        aligned=aligned, template=os.path.join(cwd, "stls", CASE_FILES[casetype])
+    )
+    if os.path.exists(customizations):
+        carve_inputs["customizations"] = customizations
+    carve_outputs = dict(headcase=outfile)
+    if check_clearance and clearance_map is not None:
+        carve_outputs["clearance_map"] = clearance_map
+    _run_stage(
         working_dir,
-        casetype=casetype,
-        nparts=nparts,
-        customizations=customizations,
-        expand_head_model=expand_head_model
+        "carve",
+        inputs=carve_inputs,
+        params=dict(
+            casetype=casetype,
+            nparts=nparts,
+            expand_head_model=expand_head_model,
+            backend=carve_backend,
+            decimate_faces=decimate_faces,
+            decimate_max_error=decimate_max_error,
+            check_clearance=check_clearance,
+            clearance_threshold=clearance_threshold,
+        ),
+        outputs=carve_outputs,
+        run=lambda: gen_case(
+            aligned,
+            outfile,
+            working_dir,
+            casetype=casetype,
+            nparts=nparts,
+            customizations=customizations,
+            expand_head_model=expand_head_model,
+            backend=carve_backend,
+            n_jobs=carve_jobs,
+            decimate_faces=decimate_faces,
+            decimate_max_error=decimate_max_error,
+            check_clearance=check_clearance,
+            clearance_threshold=clearance_threshold,
+            clearance_map=clearance_map,
+        ),
+        resume=resume,
     )
 
-    if workdir is None:
-        shutil.rmtree(working_dir)
-
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
@@ -448,6 +1564,146 @@ if __name__ == "__main__":
         "model. It is not recommended to pass a value greater than 1 mm or less than "
         "-1 mm.",
     )
+    parser.add_argument(
+        "--align-levels",
+        type=parse_align_levels,
+        default=None,
+        help="Coarse-to-fine schedule for the automatic alignment, as a "
+        "comma-separated list of the number of vertices used at each level, where "
+        "'full' uses all vertices (e.g., 2000,full). The alignment is first "
+        "optimized on a spatially uniform subsample of the head model, then refined "
+        "on the denser ones. Default: 2000,20000,full",
+    )
+    parser.add_argument(
+        "--no-align-grid-search",
+        action="store_true",
+        help="Only start the automatic alignment from the original orientation of "
+        "the head model. By default, a grid of candidate head orientations is scored "
+        "and the best ones are also refined, which helps with head models captured "
+        "at unusual angles.",
+    )
+    parser.add_argument(
+        "--align-jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to refine the candidate alignments in "
+        "parallel. Default: 1",
+    )
+    parser.add_argument(
+        "--align-model",
+        type=str,
+        default=None,
+        help="GMM head model the head model is aligned to, e.g. a compact or "
+        "pruned one written by compact_gmm.py. Default: the model shipped in "
+        "autocase3d/gmm_params.npz",
+    )
+    parser.add_argument(
+        "--subject",
+        type=str,
+        default=None,
+        help="Identifier of the subject. The alignment of the head model is stored, "
+        "and the alignment of the next head models of the subject starts from it "
+        "when they were scanned in a similar position, which is faster",
+    )
+    parser.add_argument(
+        "--no-warm-start",
+        action="store_true",
+        help="Do not start the alignment from the stored alignment of --subject "
+        "(it is still updated)",
+    )
+    parser.add_argument(
+        "--carve-backend",
+        type=str,
+        default="blender",
+        choices=["blender", "manifold"],
+        help="Library used to carve the head model out of the headcase: blender "
+        "(runs Blender in a subprocess) or manifold (runs the boolean operations "
+        "in-process with the manifold3d python package, without Blender). "
+        "Default: blender",
+    )
+    parser.add_argument(
+        "--carve-jobs",
+        type=int,
+        default=None,
+        help="Number of processes cutting the parts of the carved headcase in "
+        "parallel. Default: one per part, up to the number of CPUs",
+    )
+    parser.add_argument(
+        "--decimate-faces",
+        type=int,
+        default=None,
+        help="Decimate the aligned head model to this number of faces (e.g., "
+        "100000) before carving it, as long as it deviates from the aligned head "
+        "model by less than --decimate-max-error. This can make carving faster "
+        "with dense head models. By default, the head model is carved as is.",
+    )
+    parser.add_argument(
+        "--decimate-max-error",
+        type=float,
+        default=DECIMATE_MAX_ERROR,
+        help="Largest deviation (in mm) of the decimated head model from the "
+        f"aligned one. Default: {DECIMATE_MAX_ERROR}",
+    )
+    parser.add_argument(
+        "--clearance-threshold",
+        type=float,
+        default=CLEARANCE_THRESHOLD,
+        help="After carving, the clearance between the aligned head model and the "
+        "headcase is measured at every vertex of the head model, and the regions "
+        "with a clearance below this value (in mm, negative where the headcase cuts "
+        f"into the head model) are reported. Default: {CLEARANCE_THRESHOLD}",
+    )
+    parser.add_argument(
+        "--clearance-map",
+        type=str,
+        default=None,
+        help="Save the aligned head model to this PLY file, with its vertices colored "
+        "by clearance: red below --clearance-threshold, from green to blue up to "
+        f"{CLEARANCE_MAX_DISTANCE} mm, and gray where it is not covered by the "
+        "headcase",
+    )
+    parser.add_argument(
+        "--no-clearance-check",
+        action="store_true",
+        help="Do not measure the clearance between the head model and the headcase.",
+    )
+    parser.add_argument(
+        "--ignore-preflight",
+        action="store_true",
+        help="Carve the headcase even if the pre-flight check fails. Before carving, "
+        "the aligned head model is checked against the coil template, and the script "
+        "stops if the head model sticks out of it too much, which usually means that "
+        "the alignment failed.",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="Clean the head model at a lower quality (coarser surface "
+        "reconstruction and decimation), which is faster, e.g. to quickly check "
+        "the fit of the headcase. Do not use it for the headcase to print.",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Rerun all the stages of the pipeline. By default, the stages whose "
+        "outputs are already in the working directory (see --workdir), from a "
+        "previous run with the same inputs and parameters, are skipped.",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Write a JSON report of the run to this file: wall time, CPU time and "
+        "peak memory of each stage and mesh filter, iterations of the alignment "
+        "optimizer, mesh sizes, and the run time and output of Blender",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Profile the Python code of the pipeline with cProfile, and write the "
+        "statistics to this file (e.g., to inspect with `python -m pstats`)",
+    )
     args = parser.parse_args()
     infile = os.path.abspath(args.infile)
     outfile = os.path.abspath(args.outfile)
@@ -457,25 +1713,82 @@ if __name__ == "__main__":
     customizations = args.customizations_file
     generate_headcase_only = args.generate_headcase_only
     expand_head_model = args.expand_head_model
+    align_levels = args.align_levels
+    align_grid_search = not args.no_align_grid_search
+    align_jobs = args.align_jobs
+    align_model = args.align_model
+    subject = args.subject
+    align_warm_start = not args.no_warm_start
+    if align_model is not None:
+        align_model = os.path.abspath(align_model)
+    carve_backend = args.carve_backend
+    carve_jobs = args.carve_jobs
+    resume = not args.no_resume
+    clean_quality = "preview" if args.preview else "full"
+    decimate_faces = args.decimate_faces
+    decimate_max_error = args.decimate_max_error
+    check_clearance = not args.no_clearance_check
+    clearance_threshold = args.clearance_threshold
+    clearance_map = args.clearance_map
+    preflight_abort = not args.ignore_preflight
+    if clearance_map is not None:
+        clearance_map = os.path.abspath(clearance_map)
 
-    if generate_headcase_only:
-        print("Making head case")
-        gen_case(
-            infile,
-            outfile,
-            casetype=casetype,
-            nparts=nparts,
-            workdir=workdir,
-            customizations=customizations,
-            expand_head_model=expand_head_model,
-        )
-    else:
-        pipeline(
-            infile,
-            outfile,
-            casetype=casetype,
-            nparts=nparts,
-            workdir=workdir,
-            customizations=customizations,
-            expand_head_model=expand_head_model,
-        )
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if generate_headcase_only:
+            preflight_check(infile, casetype, abort=preflight_abort)
+            print("Making head case")
+            gen_case(
+                infile,
+                outfile,
+                casetype=casetype,
+                nparts=nparts,
+                workdir=workdir,
+                customizations=customizations,
+                expand_head_model=expand_head_model,
+                backend=carve_backend,
+                n_jobs=carve_jobs,
+                decimate_faces=decimate_faces,
+                decimate_max_error=decimate_max_error,
+                check_clearance=check_clearance,
+                clearance_threshold=clearance_threshold,
+                clearance_map=clearance_map,
+            )
+        else:
+            pipeline(
+                infile,
+                outfile,
+                casetype=casetype,
+                nparts=nparts,
+                workdir=workdir,
+                customizations=customizations,
+                expand_head_model=expand_head_model,
+                align_levels=align_levels,
+                align_grid_search=align_grid_search,
+                align_jobs=align_jobs,
+                align_model=align_model,
+                subject=subject,
+                align_warm_start=align_warm_start,
+                carve_backend=carve_backend,
+                carve_jobs=carve_jobs,
+                resume=resume,
+                clean_quality=clean_quality,
+                decimate_faces=decimate_faces,
+                decimate_max_error=decimate_max_error,
+                check_clearance=check_clearance,
+                clearance_threshold=clearance_threshold,
+                clearance_map=clearance_map,
+                preflight_abort=preflight_abort,
+            )
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {args.profile}")
+        if args.report is not None:
+            instrument.write_report(args.report, argv=sys.argv)
+            print(f"Report written to {args.report}")
@@ -0,0 +1,48 @@
+"""Build the cached coil templates with the customizations carved out.
+
+`make_headcase.py` builds these templates on first use; running this script
+beforehand (e.g., when building a Docker image) avoids paying for it when
+generating the first headcase.
+"""
+import argparse
+import os
+
+from make_headcase import CASE_FILES, DEFAULT_CUSTOMIZATIONS, cwd, precarved_template
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--headcoil",
+        "-c",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=sorted(CASE_FILES),
+        help="Types of headcoil to prepare. Default: all the available ones",
+    )
+    parser.add_argument(
+        "--customizations-file",
+        type=str,
+        default=DEFAULT_CUSTOMIZATIONS,
+        help=f"Customizations file. Default: {DEFAULT_CUSTOMIZATIONS}",
+    )
+    parser.add_argument(
+        "--carve-backend",
+        type=str,
+        default="blender",
+        choices=["blender", "manifold"],
+        help="Library that will be used to carve the headcases. Default: blender",
+    )
+    args = parser.parse_args()
+
+    casetypes = args.headcoil
+    if casetypes is None:
+        casetypes = [
+            casetype
+            for casetype, fn in sorted(CASE_FILES.items())
+            if os.path.exists(os.path.join(cwd, "stls", fn))
+        ]
+    customizations = os.path.abspath(args.customizations_file)
+    for casetype in casetypes:
+        path = precarved_template(casetype, customizations, backend=args.carve_backend)
+        print(f"{casetype}: {path}")
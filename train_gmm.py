@@ -0,0 +1,93 @@
+"""Train the GMM head model used for alignment on aligned head models.
+
+The inputs are aligned head models (STL files, e.g. the `02aligned.stl` of the
+working directories of `make_headcase.py`), or directories searched for them.
+Their features are extracted in parallel into --feature-dir, where the features
+of head models seen by a previous run are reused, and the GMM is fitted on
+mini-batches of their features (see `autocase3d.train`). The model is saved in
+the format of `autocase3d/gmm_params.npz`, and can be used with
+`make_headcase.py --align-model`, or converted with `compact_gmm.py`.
+
+Example
+-------
+python train_gmm.py workdirs/ gmm_params.npz --feature-dir features/ --workers 8
+"""
+import argparse
+import glob
+import os
+
+from autocase3d import train
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "inputs", type=str, nargs="+", help="Aligned head models, or directories"
+    )
+    parser.add_argument("outfile", type=str, help="GMM file to write (.npz)")
+    parser.add_argument(
+        "--feature-dir",
+        type=str,
+        default="features",
+        help="Directory of the extracted features. Default: features",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes extracting the features. Default: 1",
+    )
+    parser.add_argument(
+        "--n-components",
+        type=int,
+        default=200,
+        help="Number of components of the GMM. Default: 200",
+    )
+    parser.add_argument(
+        "--heads-per-batch",
+        type=int,
+        default=50,
+        help="Number of head models in each mini-batch. Default: 50",
+    )
+    parser.add_argument(
+        "--points-per-head",
+        type=int,
+        default=1000,
+        help="Number of vertices of each head model in a mini-batch. Default: 1000",
+    )
+    parser.add_argument(
+        "--max-epochs",
+        type=int,
+        default=20,
+        help="Largest number of passes over the head models. Default: 20",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    args = parser.parse_args()
+
+    stl_files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, "**", "*.stl")
+            stl_files.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            stl_files.append(path)
+    print(f"Extracting the features of {len(stl_files)} head models")
+    feature_files = train.extract_features(
+        stl_files, args.feature_dir, n_jobs=args.workers
+    )
+    if not feature_files:
+        parser.error("no features to train on")
+    means, stds = train.feature_stats(feature_files, n_jobs=args.workers)
+    gmm = train.fit_gmm(
+        feature_files,
+        means,
+        stds,
+        n_components=args.n_components,
+        n_ppl=args.heads_per_batch,
+        n_pts=args.points_per_head,
+        max_epochs=args.max_epochs,
+        seed=args.seed,
+    )
+    train.save_gmm_params(args.outfile, gmm, means, stds)
+    print(f"GMM written to {args.outfile}")